@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+# Benchmark the stages of the judge on a synthetic class.
+#
+#     python benchmarks/bench_pipeline.py --students 40 --tests 20 -o result.json
+#
+# The class is generated from the `examples/ta_judge` template: each student
+# submits the Makefile of the example with a program of one kind, which is
+# correct, wrong, crashing, slow, or noisy (a large output for every test).
+# The inputs are random integers, and `--large-kb` sizes the last input to
+# exercise the comparison of large outputs. Each stage is timed with the same
+# calls as `ta_judge`, and the results are printed as JSON.
+import argparse
+import configparser
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openpyxl import Workbook
+
+from local_judge.error_handler import ErrorHandler
+from local_judge.judge import LocalJudge
+from local_judge.report import Report
+from local_judge.ta_judge import TaJudge, append_log_msg, write_to_sheet
+from local_judge.version import __version__
+
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples", "ta_judge"
+)
+TEMPLATE_ZIP = os.path.join(EXAMPLE_DIR, "zip", "F12345678_HW1.zip")
+
+# Sum the numbers of the input
+PROGRAMS = {
+    "correct": """#include <stdio.h>
+int main() {
+    long long x, sum = 0;
+    while (scanf("%lld", &x) == 1) sum += x;
+    printf("%lld\\n", sum);
+}
+""",
+    "wrong": """#include <stdio.h>
+int main() {
+    long long x, sum = 1;
+    while (scanf("%lld", &x) == 1) sum += x;
+    printf("%lld\\n", sum);
+}
+""",
+    "crash": """#include <stdlib.h>
+int main() { abort(); }
+""",
+    "slow": """#include <stdio.h>
+#include <unistd.h>
+int main() {
+    long long x, sum = 0;
+    usleep(SLOW_MS * 1000);
+    while (scanf("%lld", &x) == 1) sum += x;
+    printf("%lld\\n", sum);
+}
+""",
+    "noisy": """#include <stdio.h>
+int main() {
+    long long x, sum = 0;
+    while (scanf("%lld", &x) == 1) { sum += x; printf("%lld\\n", x); }
+    printf("%lld\\n", sum);
+}
+""",
+}
+
+
+class StageTimer:
+    """Accumulate the wall time of each stage."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] += time.perf_counter() - start
+            self.counts[name] += 1
+
+    def result(self):
+        return {
+            name: {
+                "total_s": total,
+                "count": self.counts[name],
+                "mean_ms": total / self.counts[name] * 1e3,
+            }
+            for name, total in self.totals.items()
+        }
+
+
+def generate_class(root, students, tests, kinds, large_kb, slow_ms, seed):
+    """Write the archives, the tests, the student list, and the configs."""
+    rng = random.Random(seed)
+    with ZipFile(TEMPLATE_ZIP) as template:
+        makefile = template.read("F12345678_HW1/Makefile")
+    os.makedirs(os.path.join(root, "zip"))
+    book = Workbook()
+    sheet = book.active
+    sheet.append(["name", "student id"])
+    kind_of = {}
+    for i in range(students):
+        student_id = f"B{i:08d}"
+        kind = kinds[i % len(kinds)]
+        kind_of[student_id] = kind
+        sheet.append([f"{kind} {i}", student_id])
+        source = PROGRAMS[kind].replace("SLOW_MS", str(slow_ms))
+        with ZipFile(os.path.join(root, "zip", f"{student_id}_HW1.zip"), "w") as z:
+            z.writestr(f"{student_id}_HW1/Makefile", makefile)
+            z.writestr(f"{student_id}_HW1/main.c", source)
+    book.save(os.path.join(root, "student.xlsx"))
+
+    for sub in ("input", "answer"):
+        os.makedirs(os.path.join(root, "judge_resources", sub))
+    for t in range(tests):
+        count = 10
+        if t == tests - 1 and large_kb > 0:
+            # About 8 bytes for each number
+            count = large_kb * 128
+        numbers = [rng.randint(-(10**6), 10**6) for _ in range(count)]
+        name = f"t{t:04d}"
+        with open(
+            os.path.join(root, "judge_resources", "input", name + ".txt"), "w"
+        ) as f:
+            f.write(" ".join(map(str, numbers)) + "\n")
+        with open(
+            os.path.join(root, "judge_resources", "answer", name + ".out"), "w"
+        ) as f:
+            f.write(f"{sum(numbers)}\n")
+
+    with open(os.path.join(root, "ta_judge.conf"), "w") as f:
+        f.write(
+            f"""[Config]
+BuildCommand = make clean && make
+Executable = scanner
+RunCommand = ./scanner < {{input}} > {{output}}
+Inputs = {root}/judge_resources/input/*.txt
+TempOutputDir = {root}/output
+DiffCommand = diff {{answer}} {{output}}
+DeleteTempOutput = true
+AnswerDir = {root}/judge_resources/answer
+AnswerExtension = .out
+ExitOrLog = log
+ScoreDict = {{"0":"0","{tests}":"100"}}
+TotalScore = 100
+Timeout = 10
+
+[TaConfig]
+StudentList = {root}/student.xlsx
+StudentsZipContainer = {root}/zip
+StudentsPattern = ((\\w*)_HW1)\\.(.*)
+UpdateStudentPattern = {{student_id}}_HW1
+StudentsExtractDir = {root}/extract
+ScoreOutput = {root}/hw1.xlsx
+ExtractAfresh = true
+"""
+        )
+    return kind_of
+
+
+@contextmanager
+def quiet_stderr():
+    """Hide the complaints of `stty` in `Report` when there is no terminal."""
+    saved = os.dup(2)
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 2)
+    try:
+        yield
+    finally:
+        os.dup2(saved, 2)
+        os.close(saved)
+        os.close(null)
+
+
+def run_stages(root, config_overrides):
+    """Judge the class stage by stage and return the timings."""
+    ta_config = configparser.ConfigParser()
+    ta_config.read(os.path.join(root, "ta_judge.conf"))
+    for key, value in config_overrides.items():
+        ta_config["Config"][key] = value
+    eh = ErrorHandler("log", filename=os.path.join(root, "ta_judge.log"))
+    timer = StageTimer()
+    with redirect_stdout(open(os.devnull, "w")):
+        tj = TaJudge(ta_config["TaConfig"], eh)
+        lj = LocalJudge(ta_config["Config"], eh)
+        results = {}
+        for student in tj.students:
+            eh.init_student(student.id)
+            cwd = student.extract_path + os.sep
+            with timer.stage("extract"):
+                tj.extract_student(student)
+            with timer.stage("build"):
+                lj.build(student_id=student.id, cwd=cwd)
+            table = []
+            for test in lj.tests:
+                with timer.stage("run"):
+                    returncode, output_filepath, usage = lj.run(
+                        test.input_filepath, student_id=student.id, cwd=cwd
+                    )
+                with timer.stage("compare"):
+                    accept, diff = lj.compare(
+                        output_filepath,
+                        test.answer_filepath,
+                        returncode,
+                        student_id=student.id,
+                        cwd=cwd,
+                    )
+                table.append(
+                    {
+                        "test": test.test_name,
+                        "accept": accept,
+                        "diff": diff,
+                        "usage": usage,
+                    }
+                )
+            with timer.stage("compare"):
+                lj.clean_scratch(student.id)
+            with timer.stage("report"):
+                report = Report(
+                    report_verbose=1,
+                    score_dict=json.loads(lj.score_dict),
+                    total_score=int(ta_config["Config"]["TotalScore"]),
+                )
+                report.table = table
+                with quiet_stderr():
+                    report.print_report()
+                results[student.id] = append_log_msg(
+                    [1 if row["accept"] else 0 for row in table],
+                    eh.get_error(student.id),
+                )
+        with timer.stage("xlsx_write"):
+            write_to_sheet(
+                ta_config["TaConfig"]["ScoreOutput"],
+                ta_config["TaConfig"]["StudentList"],
+                results,
+                lj.tests,
+            )
+    accepted = sum(sum(r[: len(lj.tests)]) for r in results.values())
+    return timer.result(), accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of the judge on a synthetic class."
+    )
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--tests", type=int, default=10)
+    parser.add_argument(
+        "--kinds",
+        default="correct,wrong,crash,slow,noisy",
+        help="the kinds of programs assigned to the students in turn",
+    )
+    parser.add_argument(
+        "--large-kb", type=int, default=256, help="the size of the largest input"
+    )
+    parser.add_argument("--slow-ms", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a field of [Config], e.g. --set DiffCommand=builtin:exact",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the class")
+    parser.add_argument("-o", "--output", help="write the JSON into the file")
+    args = parser.parse_args()
+
+    kinds = args.kinds.split(",")
+    for kind in kinds:
+        if kind not in PROGRAMS:
+            parser.error(f"unknown kind `{kind}`, available: {', '.join(PROGRAMS)}")
+    overrides = dict(item.split("=", 1) for item in args.set)
+    root = tempfile.mkdtemp(prefix="local_judge_bench_")
+    try:
+        start = time.perf_counter()
+        kind_of = generate_class(
+            root,
+            args.students,
+            args.tests,
+            kinds,
+            args.large_kb,
+            args.slow_ms,
+            args.seed,
+        )
+        generate_time = time.perf_counter() - start
+        start = time.perf_counter()
+        stages, accepted = run_stages(root, overrides)
+        total_time = time.perf_counter() - start
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+    result = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "students": args.students,
+        "tests": args.tests,
+        "kinds": {kind: list(kind_of.values()).count(kind) for kind in kinds},
+        "large_kb": args.large_kb,
+        "overrides": overrides,
+        "accepted": accepted,
+        "generate_s": generate_time,
+        "total_s": total_time,
+        "stages": stages,
+    }
+    if args.keep:
+        result["class_dir"] = root
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+# Measure the latency of starting a tiny program for each test.
+#
+#     python benchmarks/bench_spawn.py -n 500 --ballast 512 --memory-limit 1000000000
+#
+# Each way of `LocalJudge.run` is timed: bash running the program (the way
+# before commands were run without bash), the program started directly by
+# the judge, and the program started by the launcher of `RunMode = launcher`.
+# Each program is limited and traced for its peak memory as in the judge,
+# unless `--no-memory` is given, as with `MeasureMemory = false`.
+# `--ballast` grows the judge to show that no mode copies its memory.
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_judge.launcher import Launcher, make_request
+from local_judge.sandbox import Process, resource_limits
+
+
+def bench(name, spawn, n):
+    spawn()  # warm up
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        spawn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "mode": name,
+        "mean_ms": statistics.mean(samples) * 1e3,
+        "p50_ms": samples[len(samples) // 2] * 1e3,
+        "p95_ms": samples[int(len(samples) * 0.95)] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the latency of starting a program for each test."
+    )
+    parser.add_argument("-n", type=int, default=300, help="spawns of each mode")
+    parser.add_argument("--program", default=shutil.which("true"))
+    parser.add_argument(
+        "--ballast", type=int, default=0, help="MiB of memory held by the judge"
+    )
+    parser.add_argument("--memory-limit", type=int, default=None, help="bytes")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="do not trace the peak memory"
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON only")
+    args = parser.parse_args()
+
+    ballast = bytearray(args.ballast * 1024 * 1024)
+    ballast[::4096] = b"\1" * len(ballast[::4096])  # touch every page
+    limits = resource_limits(memory_limit=args.memory_limit)
+    trace = not args.no_memory
+    workdir = tempfile.mkdtemp()
+    input_path = os.path.join(workdir, "input")
+    output_path = os.path.join(workdir, "output")
+    open(input_path, "w").close()
+
+    def bash():
+        Process(
+            f"{args.program} < {input_path} > {output_path}",
+            shell=True,
+            executable="bash",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+            limits=limits,
+            trace=trace,
+        ).communicate()
+
+    def direct():
+        with open(input_path, "rb") as stdin, open(output_path, "wb") as stdout:
+            Process(
+                [args.program],
+                stdin=stdin,
+                stdout=stdout,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+                limits=limits,
+                trace=trace,
+            ).communicate()
+
+    launcher = Launcher()
+    request = make_request(
+        [args.program],
+        workdir,
+        stdin=input_path,
+        stdout=output_path,
+        timeout=10,
+        memory_limit=args.memory_limit,
+        limits=limits,
+        trace=trace,
+    )
+
+    def launched():
+        launcher.launch(request)
+
+    results = [
+        bench("bash", bash, args.n),
+        bench("direct", direct, args.n),
+        bench("launcher", launched, args.n),
+    ]
+    launcher.close()
+    shutil.rmtree(workdir)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(
+        f"{args.n} spawns of {args.program}, ballast {args.ballast} MiB, "
+        f"memory limit {args.memory_limit}, memory traced {trace}"
+    )
+    print(f"{'mode':10}{'mean(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}")
+    for r in results:
+        print(
+            f"{r['mode']:10}{r['mean_ms']:10.3f}{r['p50_ms']:10.3f}{r['p95_ms']:10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
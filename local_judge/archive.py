@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import tarfile
+import time
+import zlib
+from zipfile import ZipFile
+
+import rarfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ExtractLimitExceeded(Exception):
+    """The archive is larger than the extraction limits."""
+
+
+class Entry:
+    """A regular file or a directory in an archive."""
+
+    __slots__ = ("name", "size", "mtime", "crc", "is_dir", "member", "mode")
+
+    def __init__(self, name, size, mtime, crc, is_dir, member, mode=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.crc = crc
+        self.is_dir = is_dir
+        self.member = member
+        self.mode = mode
+
+
+def zip_entries(archive):
+    for info in archive.infolist():
+        yield Entry(
+            info.filename,
+            info.file_size,
+            time.mktime(info.date_time + (0, 0, -1)),
+            info.CRC,
+            info.is_dir(),
+            info,
+        )
+
+
+def tar_entries(archive):
+    # Links and special files are skipped since they may point out of the
+    # extract directory
+    for info in archive:
+        if info.isfile() or info.isdir():
+            yield Entry(
+                info.name, info.size, info.mtime, None, info.isdir(), info, info.mode
+            )
+
+
+def rar_entries(archive):
+    for info in archive.infolist():
+        if info.is_symlink():
+            continue
+        mtime = (
+            info.mtime.timestamp()
+            if info.mtime
+            else time.mktime(info.date_time + (0, 0, -1))
+        )
+        yield Entry(info.filename, info.file_size, mtime, info.CRC, info.is_dir(), info)
+
+
+# The type of archive -> (open the archive, list the entries, open an entry)
+ARCHIVES = {
+    "zip": (lambda path: ZipFile(path, "r"), zip_entries, ZipFile.open),
+    "tar": (
+        lambda path: tarfile.open(path, "r"),
+        tar_entries,
+        tarfile.TarFile.extractfile,
+    ),
+    "rar": (rarfile.RarFile, rar_entries, rarfile.RarFile.open),
+}
+
+
+def is_supported(zip_type):
+    """Check whether the type of archive can be extracted."""
+    return zip_type in ARCHIVES
+
+
+def safe_path(extract_dir, name):
+    """Get the destination of an entry, which must be inside the extract directory
+
+    ../../etc/passwd -> ValueError
+    """
+    root = os.path.realpath(extract_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"`{name}` is outside the extract directory")
+    return path
+
+
+def crc32_file(path, chunk_size=CHUNK_SIZE):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_unchanged(path, entry):
+    """Check whether the entry was already extracted to the path.
+
+    The size and the mtime are checked first, and then the CRC if the
+    archive records it.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != entry.size or int(stat.st_mtime) != int(entry.mtime):
+        return False
+    return entry.crc is None or crc32_file(path) == entry.crc
+
+
+def copy_limited(src, dst, limit, chunk_size=CHUNK_SIZE):
+    """Copy at most `limit` bytes and return the number of copied bytes.
+
+    The declared size of an entry cannot be trusted, so the real size is
+    counted while decompressing.
+    """
+    copied = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > limit:
+            raise ExtractLimitExceeded(f"more than {limit} bytes after extraction")
+        dst.write(chunk)
+
+
+def extract(zip_type, zip_path, extract_dir, max_size, max_files, read_only=False):
+    """Extract the archive entry by entry into the extract directory.
+
+    Stop with `ExtractLimitExceeded` once there are more than `max_files`
+    entries or more than `max_size` bytes in total. The entries which are
+    already extracted and unchanged are skipped. The changed files are
+    replaced instead of overwritten, so their hard links are not changed.
+    Return the number of extracted files.
+    """
+    mode_mask = 0o555 if read_only else 0o755
+    open_archive, entries, open_entry = ARCHIVES[zip_type]
+    with open_archive(zip_path) as archive:
+        total_size = 0
+        pending = []
+        for count, entry in enumerate(entries(archive), 1):
+            if count > max_files:
+                raise ExtractLimitExceeded(f"more than {max_files} files")
+            path = safe_path(extract_dir, entry.name)
+            if entry.is_dir:
+                os.makedirs(path, exist_ok=True)
+                continue
+            total_size += entry.size
+            if total_size > max_size:
+                raise ExtractLimitExceeded(f"more than {max_size} bytes")
+            if is_unchanged(path, entry):
+                continue
+            pending.append((path, entry))
+
+        remaining = max_size
+        for path, entry in pending:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.remove(path)
+            with open_entry(archive, entry.member) as src, open(path, "wb") as dst:
+                remaining -= copy_limited(src, dst, remaining)
+            if entry.mode is not None:
+                os.chmod(path, entry.mode & mode_mask)
+            elif read_only:
+                os.chmod(path, 0o444)
+            os.utime(path, (entry.mtime, entry.mtime))
+    return len(pending)
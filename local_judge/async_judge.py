@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import asyncio
+import contextvars
+import os
+import signal
+from asyncio.subprocess import PIPE
+from functools import partial
+from statistics import median
+
+from . import command
+from . import comparator
+from . import trace
+from . import utils
+from .cache import tree_stats
+from .judge import LocalJudge, TLE_RETURNCODE, skipped_row
+from .sandbox import Usage
+
+
+async def kill_process_group(process, grace_period=1.0):
+    """Same as `sandbox.kill_process_group` but for an asyncio process."""
+    try:
+        pgid = os.getpgid(process.pid)
+    except ProcessLookupError:
+        await process.wait()
+        return
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pgid, signum)
+        except ProcessLookupError:
+            break
+        try:
+            await asyncio.wait_for(process.wait(), grace_period)
+        except asyncio.TimeoutError:
+            pass
+    await process.wait()
+
+
+def to_thread(func, *args, **kwargs):
+    """Same as `asyncio.to_thread`, which needs Python 3.9.
+
+    The function runs in a copy of the current context, as with asyncio.
+    """
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        None, partial(context.run, func, *args, **kwargs)
+    )
+
+
+class AsyncJudge:
+    """Run the stages of a `LocalJudge` as asyncio subprocesses.
+
+    All the programs are started and awaited by the event loop of one process,
+    so many students can be judged at the same time without a worker process
+    for each of them. The number of running subprocesses is bounded by `jobs`.
+    The programs of the tests are run on threads by `LocalJudge`, since the
+    event loop can neither limit its children nor get their resource usage.
+    """
+
+    def __init__(self, judge: LocalJudge, jobs):
+        self.judge = judge
+        self.error_handler = judge.error_handler
+        self.timeout = float(judge.timeout)
+        self.jobs = jobs
+        # Created lazily since it must belong to the running event loop
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.jobs)
+        return self._semaphore
+
+    async def _spawn(self, cmd, fields, cwd, **kwargs):
+        return await cmd.create_subprocess(
+            fields, cwd=cwd, stdout=PIPE, stderr=PIPE, start_new_session=True, **kwargs
+        )
+
+    async def _communicate(self, process, timeout):
+        """Wait for the process and return its stdout and stderr.
+
+        The process group is killed if it runs out of time or the judgement
+        is cancelled, and `asyncio.TimeoutError` or the cancellation is raised.
+        """
+        try:
+            return await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            await kill_process_group(process)
+            raise
+
+    async def build(self, student_id="local", cwd="./"):
+        """Same as `LocalJudge.build`."""
+        with trace.span("build", student_id=student_id):
+            await self._build(student_id, cwd)
+
+    async def _build(self, student_id, cwd):
+        judge = self.judge
+        cache_key = None
+        before = None
+        if judge.build_cache is not None:
+            cache_key = await to_thread(
+                judge.build_cache.key, cwd, judge.build_command, judge.executable
+            )
+            if await to_thread(
+                judge.build_cache.restore, cache_key, cwd + judge.executable
+            ):
+                return
+            before = await to_thread(tree_stats, cwd)
+        err = b""
+        async with self.semaphore:
+            process = await self._spawn(
+                command.parse(judge.build_command), {}, cwd, env=judge.build_env
+            )
+            try:
+                _, err = await self._communicate(process, judge.build_timeout)
+            except asyncio.TimeoutError:
+                self.error_handler.handle(
+                    f"TLE at build stage; kill `{judge.build_command}`",
+                    student_id=student_id,
+                )
+        await to_thread(
+            judge._check_build,
+            process.returncode,
+            err,
+            student_id,
+            cwd,
+            cache_key,
+            before,
+        )
+
+    async def run(self, input_filepath, student_id="local", cwd="./"):
+        """Same as `LocalJudge.run`, which is left on a thread.
+
+        The program is started and reaped by `LocalJudge`, so that it is
+        limited and measured the same way in every run mode.
+        """
+        async with self.semaphore:
+            return await to_thread(
+                self.judge.run, input_filepath, student_id=student_id, cwd=cwd
+            )
+
+    async def compare(
+        self,
+        output_filepath,
+        answer_filepath,
+        run_returncode,
+        student_id="local",
+        cwd="./",
+        render_diff=True,
+    ):
+        """Same as `LocalJudge.compare`."""
+        with trace.span(
+            "compare", student_id=student_id, test=utils.get_filename(answer_filepath)
+        ):
+            return await self._compare(
+                output_filepath,
+                answer_filepath,
+                run_returncode,
+                student_id,
+                cwd,
+                render_diff,
+            )
+
+    async def _compare(
+        self,
+        output_filepath,
+        answer_filepath,
+        run_returncode,
+        student_id,
+        cwd,
+        render_diff,
+    ):
+        judge = self.judge
+        checked = judge._check_output(
+            output_filepath, answer_filepath, run_returncode, student_id
+        )
+        if checked is not None:
+            return checked
+        if comparator.is_builtin(judge.diff_command):
+            accept = await to_thread(
+                comparator.compare, judge.diff_command, output_filepath, answer_filepath
+            )
+            diff = ""
+            if not accept and render_diff:
+                _, diff = await self._diff(
+                    judge.diff_render_command,
+                    output_filepath,
+                    answer_filepath,
+                    student_id,
+                    cwd,
+                )
+        else:
+            accept, diff = await self._diff(
+                judge.diff_command, output_filepath, answer_filepath, student_id, cwd
+            )
+        return accept, diff
+
+    async def _diff(
+        self, diff_command, output_filepath, answer_filepath, student_id, cwd
+    ):
+        cmd, fields = self.judge._diff_cmd(
+            diff_command, output_filepath, answer_filepath
+        )
+        async with self.semaphore:
+            process = await self._spawn(cmd, fields, cwd)
+            try:
+                out, err = await self._communicate(process, self.timeout)
+            except asyncio.TimeoutError:
+                self.error_handler.handle(
+                    f"TLE at compare stage; kill `{cmd.render(**fields)}`",
+                    student_id=student_id,
+                )
+                return False, ""
+        return self.judge._check_diff(process.returncode, out, err, student_id)
+
+    async def _run_and_compare(self, test, student_id, cwd, render_diff):
+        """Return the returncode, the accept, the diff, and the usage of the test."""
+        judge = self.judge
+        if judge.run_mode == "pipe":
+            # The output is compared while it is read by the selector loop of
+            # `LocalJudge.run_piped`, which is left on a thread
+            async with self.semaphore:
+                return await to_thread(
+                    judge.run_piped,
+                    test.input_filepath,
+                    test.answer_filepath,
+                    student_id=student_id,
+                    cwd=cwd,
+                    render_diff=render_diff,
+                )
+        returncode, output_filepath, usage = await self.run(
+            test.input_filepath, student_id=student_id, cwd=cwd
+        )
+        accept, diff = await self.compare(
+            output_filepath,
+            test.answer_filepath,
+            returncode,
+            student_id=student_id,
+            cwd=cwd,
+            render_diff=render_diff,
+        )
+        return returncode, accept, diff, usage
+
+    async def judge_test(
+        self,
+        test,
+        student_id="local",
+        cwd="./",
+        render_diff=True,
+        executable_hash=None,
+    ):
+        """Same as `LocalJudge.judge_test`."""
+        judge = self.judge
+        cache_key, row = await to_thread(
+            judge._cached_row, test, executable_hash, render_diff, student_id
+        )
+        if row is not None:
+            return row
+        with self.error_handler.capture() as errors:
+            returncode, accept, diff, usage = await self._run_and_compare(
+                test, student_id, cwd, render_diff
+            )
+        # TLE depends on the load of the machine, so it is not cached
+        if cache_key is not None and returncode != TLE_RETURNCODE:
+            await to_thread(judge.result_cache.put, cache_key, accept, diff, errors)
+        if accept and judge.repeat > 1:
+            usages = [usage]
+            for _ in range(judge.repeat - 1):
+                if judge.run_mode == "pipe":
+                    returncode, _, _, usage = await self._run_and_compare(
+                        test, student_id, cwd, False
+                    )
+                else:
+                    returncode, _, usage = await self.run(
+                        test.input_filepath, student_id=student_id, cwd=cwd
+                    )
+                if returncode == 0:
+                    usages.append(usage)
+            usage = Usage(
+                *(None if None in values else median(values) for values in zip(*usages))
+            )
+        return {
+            "test": test.test_name,
+            "accept": accept,
+            "diff": diff,
+            "usage": usage,
+        }
+
+    @staticmethod
+    async def _new_task(coro):
+        """Await the coroutine in a task with a tid of its own in the trace."""
+        trace.new_task()
+        return await coro
+
+    async def judge_tests(
+        self, student_id="local", cwd="./", render_diff=True, max_failures=None
+    ):
+        """Judge all tests at the same time and return the rows in order.
+
+        With `max_failures` given, the tests are judged one by one in the
+        order of `test_order`, and the rest are skipped once `max_failures`
+        tests are rejected.
+        """
+        judge = self.judge
+        executable_hash = await to_thread(judge.executable_hash, cwd)
+        # Made before the threads of the runs, which would race to make it
+        await to_thread(judge.scratch_path, student_id)
+        if max_failures is None:
+            return await asyncio.gather(
+                *(
+                    self._new_task(
+                        self.judge_test(
+                            test, student_id, cwd, render_diff, executable_hash
+                        )
+                    )
+                    for test in judge.tests
+                )
+            )
+        rows = [None] * len(judge.tests)
+        failures = 0
+        for i in judge.test_order:
+            if failures >= max_failures:
+                rows[i] = skipped_row(judge.tests[i])
+                continue
+            rows[i] = await self.judge_test(
+                judge.tests[i], student_id, cwd, render_diff, executable_hash
+            )
+            if not rows[i]["accept"]:
+                failures += 1
+        return rows
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from contextlib import closing
+from shutil import copyfile, copymode
+
+from . import utils
+
+CHUNK_SIZE = 64 * 1024
+
+
+def hash_file(path, h=None, chunk_size=CHUNK_SIZE):
+    """Feed the content of the file into the hash object."""
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h
+
+
+def hash_tree(src_dir, h=None, exclude=()):
+    """Feed the relative paths and the contents of all files into the hash object.
+
+    The directory is walked in sorted order so the hash is stable across runs.
+    """
+    if h is None:
+        h = hashlib.sha256()
+    exclude = {os.path.normpath(path) for path in exclude}
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, src_dir)
+            if rel_path in exclude:
+                continue
+            h.update(rel_path.encode("utf8") + b"\0")
+            if os.path.islink(path):
+                h.update(os.readlink(path).encode("utf8"))
+            elif os.path.isfile(path):
+                hash_file(path, h)
+            h.update(b"\0")
+    return h
+
+
+def tree_stats(src_dir):
+    """Get the [size, mtime_ns] of every file in the tree by its relative path."""
+    stats = {}
+    for root, _, files in os.walk(src_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            stats[os.path.relpath(path, src_dir)] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+class BuildCache:
+    """Content-addressed cache of the built executables.
+
+    The key is the hash of the source tree plus the build command. The files
+    written by the last build of the tree, e.g. `*.o` or `lex.yy.c`, are left
+    out of the key while they are unchanged, so the tree keeps its key after
+    it is built. The cache directory may be shared by many processes; each
+    entry is written atomically, and the least recently used entries are
+    evicted when the total size exceeds `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, src_dir, build_command, executable):
+        h = hashlib.sha256()
+        h.update(build_command.encode("utf8") + b"\0")
+        h.update(executable.encode("utf8") + b"\0")
+        # The stale executable and outputs in the tree must not change the key
+        exclude = {executable, *self._outputs(src_dir, tree_stats(src_dir))}
+        return hash_tree(src_dir, h, exclude=exclude).hexdigest()
+
+    def _outputs_path(self, src_dir):
+        name = hashlib.sha256(os.path.abspath(src_dir).encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".outputs.json")
+
+    def _outputs(self, src_dir, stats):
+        """Get the outputs of the last build of the tree which are unchanged."""
+        try:
+            with open(self._outputs_path(src_dir)) as f:
+                outputs = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return {path: stat for path, stat in outputs.items() if stats.get(path) == stat}
+
+    def record_outputs(self, src_dir, before):
+        """Remember the files written by the build of the tree.
+
+        `before` is the `tree_stats` of the tree taken before the build. The
+        outputs of the earlier builds which are left unchanged, e.g. the
+        objects which make did not rebuild, are kept as well.
+        """
+        after = tree_stats(src_dir)
+        outputs = self._outputs(src_dir, after)
+        outputs.update(
+            (path, stat) for path, stat in after.items() if before.get(path) != stat
+        )
+        utils.atomic_write_json(self._outputs_path(src_dir), outputs)
+
+    def restore(self, key, executable_path):
+        """Copy the cached executable to the given path if the key is hit."""
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            copyfile(entry, executable_path)
+            copymode(entry, executable_path)
+            # Mark the entry as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, executable_path):
+        entry = os.path.join(self.cache_dir, key)
+        temp_entry = entry + "." + str(os.getpid()) + ".tmp"
+        copyfile(executable_path, temp_entry)
+        copymode(executable_path, temp_entry)
+        os.replace(temp_entry, entry)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".tmp"):
+                continue  # being written by another process
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class ResultCache:
+    """Persistent cache of the verdicts stored in a SQLite database.
+
+    The key is made by the caller from everything that decides the verdict:
+    the executable, the input, the answer, and the related config fields.
+    A connection is opened for each access so the object can be sent to the
+    pool workers, and SQLite handles the locking between them.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "key TEXT PRIMARY KEY, accept INTEGER NOT NULL, diff TEXT NOT NULL, "
+                "errors TEXT)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(verdicts)")]
+            if "errors" not in columns:
+                # The verdicts cached without their errors are judged again
+                conn.execute("ALTER TABLE verdicts ADD COLUMN errors TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    @staticmethod
+    def key(*fields):
+        return hashlib.sha256("\0".join(fields).encode("utf8")).hexdigest()
+
+    def get(self, key):
+        """Return `(accept, diff, errors)` of the key, or None if it is missed.
+
+        `errors` is the list of the messages logged when the verdict was made.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT accept, diff, errors FROM verdicts WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[2] is None:
+            return None
+        return bool(row[0]), row[1], json.loads(row[2])
+
+    def put(self, key, accept, diff, errors=()):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, accept, diff, errors) "
+                "VALUES (?, ?, ?, ?)",
+                (key, int(accept), diff, json.dumps(list(errors))),
+            )
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import os
+
+from . import utils
+
+
+def load(path):
+    """Load the baseline wall time of each test, or {} if not calibrated."""
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["baselines"]
+
+
+def save(path, baselines, runs):
+    utils.atomic_write_json(path, {"runs": runs, "baselines": baselines}, indent=2)
+
+
+def timeouts(baselines, factor, floor):
+    """Derive the timeout of each test from its baseline
+
+    0.5 with factor 3 and floor 1 -> 2.5
+    """
+    return {name: factor * baseline + floor for name, baseline in baselines.items()}
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import asyncio
+import os
+import re
+import shlex
+from functools import lru_cache
+from subprocess import Popen
+
+# The features which are left to bash: control operators, pipes, expansions,
+# globs, comments, and the redirections other than <, >, and >>
+SHELL_CHARS = set("|&;()$`*?[]~!#\n")
+SHELL_REDIRECTIONS = re.compile(r"\d+>|>&|&>|<<|<>|>\|")
+PLACEHOLDERS = re.compile(r"{(input|output|answer)}")
+REDIRECTIONS = {"<": ("stdin", "rb"), ">": ("stdout", "wb"), ">>": ("stdout", "ab")}
+
+
+def fill(template, fields):
+    """Substitute the placeholders without treating the values as patterns
+
+    ./a < {input}, {"input": "a.txt"} -> ./a < a.txt
+    """
+    for name, value in fields.items():
+        template = template.replace("{" + name + "}", value)
+    return template
+
+
+class Command:
+    """A command template of the config, which is parsed only once.
+
+    A simple command such as `./scanner < {input} > {output}` is run without
+    bash: it is split into an argv list, and its redirections are opened by
+    the judge. The other commands, e.g. `make clean && make`, are run by bash.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.argv = None
+        self.redirections = {}
+        if not self._needs_shell(template):
+            self._parse(template)
+
+    @staticmethod
+    def _needs_shell(template):
+        rest = PLACEHOLDERS.sub("_", template)
+        return (
+            any(c in SHELL_CHARS for c in rest)
+            or "{" in rest
+            or SHELL_REDIRECTIONS.search(rest) is not None
+        )
+
+    def _parse(self, template):
+        lexer = shlex.shlex(template, posix=True, punctuation_chars="<>")
+        lexer.whitespace_split = True
+        try:
+            tokens = list(lexer)
+        except ValueError:
+            # Unbalanced quotes are reported by bash
+            return
+        argv = []
+        redirections = {}
+        while tokens:
+            token = tokens.pop(0)
+            if token in REDIRECTIONS:
+                stream, mode = REDIRECTIONS[token]
+                if not tokens or tokens[0][0] in "<>" or stream in redirections:
+                    return
+                redirections[stream] = (tokens.pop(0), mode)
+            elif token[0] in "<>":
+                return
+            else:
+                argv.append(token)
+        # An assignment before the command is a shell feature as well
+        if argv == [] or "=" in argv[0]:
+            return
+        self.argv = argv
+        self.redirections = redirections
+
+    @property
+    def shell(self):
+        return self.argv is None
+
+    def render(self, **fields):
+        """The command line after substitution, which is run by bash if needed."""
+        return fill(self.template, fields)
+
+    def expand(self, fields, cwd="./"):
+        """Get the argv and the redirected files of a command run without bash.
+
+        The redirections are a dict of stream -> (path, mode), where the
+        redirections to the judge itself, e.g. `/dev/stdout` in
+        `RunMode = pipe`, are left out.
+        """
+        redirections = {}
+        for stream, (path, mode) in self.redirections.items():
+            path = fill(path, fields)
+            if path != "/dev/" + stream:
+                redirections[stream] = (os.path.join(cwd, path), mode)
+        return [fill(arg, fields) for arg in self.argv], redirections
+
+    def _open_redirections(self, cwd, fields):
+        files = {}
+        try:
+            for stream, (path, mode) in self.expand(fields, cwd)[1].items():
+                files[stream] = open(path, mode)
+        except OSError:
+            for f in files.values():
+                f.close()
+            raise
+        return files
+
+    def popen(self, fields, cwd="./", popen_class=Popen, **kwargs):
+        """Start the command with the placeholders substituted by the fields.
+
+        If the program or a redirected file cannot be opened, the command is
+        run by bash instead, so that the error is reported the same way.
+        """
+        if not self.shell:
+            try:
+                files = self._open_redirections(cwd, fields)
+            except OSError:
+                pass
+            else:
+                try:
+                    return popen_class(
+                        [fill(arg, fields) for arg in self.argv],
+                        cwd=cwd,
+                        **{**kwargs, **files},
+                    )
+                except OSError:
+                    pass
+                finally:
+                    for f in files.values():
+                        f.close()
+        return popen_class(
+            self.render(**fields), shell=True, executable="bash", cwd=cwd, **kwargs
+        )
+
+    async def create_subprocess(self, fields, cwd="./", **kwargs):
+        """Same as `popen` but for asyncio."""
+        if not self.shell:
+            try:
+                files = self._open_redirections(cwd, fields)
+            except OSError:
+                pass
+            else:
+                try:
+                    return await asyncio.create_subprocess_exec(
+                        *(fill(arg, fields) for arg in self.argv),
+                        cwd=cwd,
+                        **{**kwargs, **files},
+                    )
+                except OSError:
+                    pass
+                finally:
+                    for f in files.values():
+                        f.close()
+        return await asyncio.create_subprocess_shell(
+            self.render(**fields), executable="bash", cwd=cwd, **kwargs
+        )
+
+
+@lru_cache(maxsize=None)
+def parse(template):
+    """Get the parsed command of the template, which is shared by all calls."""
+    return Command(template)
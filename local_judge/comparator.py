@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import difflib
+import mmap
+import os
+from contextlib import contextmanager
+from itertools import zip_longest
+
+BUILTIN_PREFIX = "builtin:"
+CHUNK_SIZE = 64 * 1024
+
+
+def is_builtin(diff_command):
+    """Check whether the `DiffCommand` asks for a built-in comparator
+
+    builtin:exact -> True
+    """
+    return diff_command.strip().startswith(BUILTIN_PREFIX)
+
+
+def get_builtin_name(diff_command):
+    """Get the name of the built-in comparator
+
+    builtin:exact -> exact
+    """
+    return diff_command.strip()[len(BUILTIN_PREFIX) :]
+
+
+def compare_exact(output_filepath, answer_filepath, chunk_size=CHUNK_SIZE):
+    """Check whether two files are byte-identical.
+
+    The files are read chunk by chunk and the comparison stops at the first
+    mismatched chunk.
+    """
+    if os.path.getsize(output_filepath) != os.path.getsize(answer_filepath):
+        return False
+    with open(output_filepath, "rb") as output, open(answer_filepath, "rb") as answer:
+        while True:
+            output_chunk = output.read(chunk_size)
+            answer_chunk = answer.read(chunk_size)
+            if output_chunk != answer_chunk:
+                return False
+            if not output_chunk:
+                return True
+
+
+def compare_ignore_trailing_ws(output_filepath, answer_filepath):
+    """Check whether two files are identical line by line.
+
+    The whitespaces at the end of each line and the blank lines at the end of
+    the files are ignored. The comparison stops at the first mismatched line.
+    """
+    with open(output_filepath, "rb") as output, open(answer_filepath, "rb") as answer:
+        for output_line, answer_line in zip_longest(output, answer, fillvalue=b""):
+            if output_line.rstrip() != answer_line.rstrip():
+                return False
+    return True
+
+
+COMPARATORS = {
+    "exact": compare_exact,
+    "ignore-trailing-ws": compare_ignore_trailing_ws,
+}
+
+
+def compare(diff_command, output_filepath, answer_filepath):
+    """Compare the output with the answer by the given built-in comparator."""
+    return COMPARATORS[get_builtin_name(diff_command)](output_filepath, answer_filepath)
+
+
+@contextmanager
+def map_answer(answer_filepath):
+    """Memory-map the answer file, where an empty file cannot be mapped."""
+    with open(answer_filepath, "rb") as answer_file:
+        if os.fstat(answer_file.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(answer_file.fileno(), 0, access=mmap.ACCESS_READ) as answer:
+            yield answer
+
+
+class ExactStream:
+    """Compare the output chunk by chunk with the answer as it is produced."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.pos = 0
+
+    def feed(self, chunk):
+        """Consume the next chunk of output and return False on a mismatch."""
+        end = self.pos + len(chunk)
+        if self.answer[self.pos : end] != chunk:
+            return False
+        self.pos = end
+        return True
+
+    def finish(self):
+        """Return True if the whole output matched the whole answer."""
+        return self.pos == len(self.answer)
+
+
+class IgnoreTrailingWsStream:
+    """Compare the output line by line with the answer as it is produced.
+
+    Same rules as `compare_ignore_trailing_ws`. The chunks of an unfinished
+    line are kept in a list and joined once the line ends, so a long line fed
+    in many small chunks is not copied again for each of them.
+    """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.pos = 0
+        self.pending = []
+
+    def _next_answer_line(self):
+        end = self.answer.find(b"\n", self.pos)
+        end = len(self.answer) if end == -1 else end + 1
+        line = self.answer[self.pos : end]
+        self.pos = end
+        return line
+
+    def feed(self, chunk):
+        if b"\n" not in chunk:
+            if chunk:
+                self.pending.append(chunk)
+            return True
+        self.pending.append(chunk)
+        lines = b"".join(self.pending).split(b"\n")
+        last = lines.pop()
+        self.pending = [last] if last else []
+        for line in lines:
+            if line.rstrip() != self._next_answer_line().rstrip():
+                return False
+        return True
+
+    def finish(self):
+        pending = b"".join(self.pending)
+        if pending and pending.rstrip() != self._next_answer_line().rstrip():
+            return False
+        while self.pos < len(self.answer):
+            if self._next_answer_line().rstrip() != b"":
+                return False
+        return True
+
+
+STREAM_COMPARATORS = {
+    "exact": ExactStream,
+    "ignore-trailing-ws": IgnoreTrailingWsStream,
+}
+
+
+def compare_stream(diff_command, answer):
+    """Create the streaming comparator of the given built-in comparator."""
+    return STREAM_COMPARATORS[get_builtin_name(diff_command)](answer)
+
+
+def render_diff(answer, output, answer_filepath):
+    """Render the differences in unified format when there is no output file."""
+    return "".join(
+        difflib.unified_diff(
+            str(bytes(answer), encoding="utf8", errors="ignore").splitlines(True),
+            str(output, encoding="utf8", errors="ignore").splitlines(True),
+            answer_filepath,
+            "yours",
+        )
+    )
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+from collections import Counter, namedtuple
+
+from .cache import BuildCache, hash_file
+from .utils import parse_size
+
+CACHE_DIR_ENV = "LOCAL_JUDGE_COMPILER_CACHE_DIR"
+CACHE_SIZE_ENV = "LOCAL_JUDGE_COMPILER_CACHE_SIZE"
+STATS_ENV = "LOCAL_JUDGE_COMPILER_CACHE_STATS"
+
+# The compilers which are wrapped by a shim of the same name on `PATH`
+COMPILERS = ("cc", "gcc", "g++", "c++", "clang", "clang++")
+SOURCE_EXTENSIONS = (".c", ".cc", ".cpp", ".cxx", ".C", ".i", ".ii")
+OBJECT_EXTENSIONS = (".o", ".a")
+# The options whose value is the next argument
+SEPARATE_OPTIONS = {
+    "-o",
+    "-I",
+    "-D",
+    "-U",
+    "-L",
+    "-l",
+    "-include",
+    "-imacros",
+    "-isystem",
+    "-iquote",
+    "-idirafter",
+    "-Xlinker",
+}
+# The options which write other files or change the language of the inputs
+UNCACHEABLE_OPTIONS = (
+    "-E",
+    "-S",
+    "-M",
+    "-Wp,-M",
+    "-x",
+    "-save-temps",
+    "--coverage",
+    "-fprofile",
+)
+
+# `options` are passed to the preprocessor and `inputs` are the files
+Invocation = namedtuple("Invocation", ("options", "sources", "objects", "output"))
+
+
+def parse_invocation(args):
+    """Split the arguments of the compiler, or return None if it cannot be cached.
+
+    Only the compilations of one source with `-c`, and the builds of an
+    executable from sources and objects, are cached.
+    """
+    options, sources, objects = [], [], []
+    output = None
+    compile_only = False
+    args = iter(args)
+    for arg in args:
+        if arg == "-o":
+            output = next(args, None)
+        elif arg == "-c":
+            compile_only = True
+        elif arg.startswith(UNCACHEABLE_OPTIONS):
+            return None
+        elif arg in SEPARATE_OPTIONS:
+            options += [arg, next(args, "")]
+        elif arg.startswith("-"):
+            if arg == "-":
+                return None
+            options.append(arg)
+        elif arg.endswith(SOURCE_EXTENSIONS):
+            sources.append(arg)
+        elif arg.endswith(OBJECT_EXTENSIONS):
+            objects.append(arg)
+        else:
+            return None  # response files, linker scripts and so on
+    if compile_only:
+        if len(sources) != 1 or objects:
+            return None
+        if output is None:
+            output = os.path.splitext(os.path.basename(sources[0]))[0] + ".o"
+        options.append("-c")
+    elif not sources:
+        return None  # nothing to preprocess
+    return Invocation(options, sources, objects, output or "a.out")
+
+
+def invocation_key(compiler, invocation):
+    """Hash the compiler, the options, the preprocessed sources and the objects.
+
+    Return None if a source cannot be preprocessed.
+    """
+    h = hashlib.sha256()
+    stat = os.stat(compiler)
+    h.update(f"{compiler}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode("utf8"))
+    h.update("\0".join(invocation.options).encode("utf8") + b"\0")
+    preprocess_options = [o for o in invocation.options if o != "-c"]
+    for source in invocation.sources:
+        process = subprocess.run(
+            [compiler, *preprocess_options, "-E", source],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        if process.returncode != 0:
+            return None
+        h.update(source.encode("utf8") + b"\0" + process.stdout + b"\0")
+    for obj in invocation.objects:
+        h.update(obj.encode("utf8") + b"\0")
+        hash_file(obj, h)
+    return h.hexdigest()
+
+
+def record(result):
+    """Append `hit` or `miss` to the stats file of the run."""
+    stats_path = os.environ.get(STATS_ENV)
+    if stats_path is None:
+        return
+    fd = os.open(stats_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, result.encode("utf8") + b"\n")
+    finally:
+        os.close(fd)
+
+
+class CompilerCache:
+    """Cache of the compiler outputs shared by all builds.
+
+    The builds find the shims of the compilers first on `PATH`, and each shim
+    runs `main` with the real compiler. The outputs are kept in a `BuildCache`
+    keyed by the preprocessed sources, so the same translation unit of any
+    student is only compiled once. The hits and misses are counted in a
+    stats file of this run.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.bin_dir = os.path.join(self.cache_dir, "bin")
+        stats_dir = os.path.join(self.cache_dir, "stats")
+        os.makedirs(self.bin_dir, exist_ok=True)
+        os.makedirs(stats_dir, exist_ok=True)
+        self.stats_path = os.path.join(stats_dir, str(os.getpid()))
+        open(self.stats_path, "w").close()
+        path = os.environ.get("PATH", os.defpath)
+        for name in COMPILERS:
+            compiler = shutil.which(name, path=path)
+            if compiler is not None:
+                self._install_shim(name, compiler)
+        self.env = {
+            **os.environ,
+            "PATH": self.bin_dir + os.pathsep + path,
+            CACHE_DIR_ENV: os.path.join(self.cache_dir, "objects"),
+            CACHE_SIZE_ENV: str(max_size),
+            STATS_ENV: self.stats_path,
+        }
+
+    def _install_shim(self, name, compiler):
+        shim = os.path.join(self.bin_dir, name)
+        temp_shim = shim + "." + str(os.getpid()) + ".tmp"
+        with open(temp_shim, "w") as f:
+            f.write(
+                "#!/bin/sh\nexec "
+                + " ".join(
+                    shlex.quote(arg)
+                    for arg in (sys.executable, "-m", __name__, compiler)
+                )
+                + ' "$@"\n'
+            )
+        os.chmod(temp_shim, 0o755)
+        os.replace(temp_shim, shim)
+
+    def pop_stats(self):
+        """Return the hits and misses of this run and remove its stats file."""
+        try:
+            with open(self.stats_path) as f:
+                counts = Counter(f.read().split())
+            os.remove(self.stats_path)
+        except FileNotFoundError:
+            counts = Counter()
+        return counts["hit"], counts["miss"]
+
+
+def main(argv=None):
+    """Run the compiler, or restore its output from the cache."""
+    compiler, *args = sys.argv[1:] if argv is None else argv
+    invocation = parse_invocation(args)
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    key = None
+    if cache_dir is not None and invocation is not None:
+        key = invocation_key(compiler, invocation)
+    if key is None:
+        os.execv(compiler, [compiler, *args])
+    cache = BuildCache(cache_dir, parse_size(os.environ.get(CACHE_SIZE_ENV, "1G")))
+    if cache.restore(key, invocation.output):
+        record("hit")
+        return 0
+    returncode = subprocess.call([compiler, *args])
+    if returncode == 0:
+        cache.store(key, invocation.output)
+    record("miss")
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,16 +24,33 @@ SOFTWARE.
 """
 import sys
 import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# The messages logged in the current context, which are collected by `capture`
+_captured = contextvars.ContextVar("captured", default=None)
 
 
 class ErrorHandler:
     def __init__(self, exit_or_log, **logging_config):
         self.exit_or_log = exit_or_log
         self.database = {}
+        # Tests of one student may be judged concurrently on threads
+        self._lock = threading.Lock()
         if logging_config == {}:
             logging_config["format"] = "%(asctime)-15s [%(levelname)s] %(message)s"
         logging.basicConfig(**logging_config)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
     def init_student(self, student_id: str):
         self.database[student_id] = ""
 
@@ -42,6 +59,23 @@ class ErrorHandler:
             return ""
         return self.database[student_id]
 
+    @contextmanager
+    def capture(self):
+        """Collect the messages logged in this context, e.g. by one test."""
+        messages = []
+        token = _captured.set(messages)
+        try:
+            yield messages
+        finally:
+            _captured.reset(token)
+
+    def append(self, student_id, msg, max_len=200):
+        """Append the messages which have been logged by another process."""
+        with self._lock:
+            if not student_id in self.database.keys():
+                self.init_student(student_id)
+            self.database[student_id] = (self.database[student_id] + msg)[:max_len]
+
     def handle(self, msg="", exit_or_log=None, student_id="", max_len=200):
         action = self.exit_or_log if exit_or_log is None else exit_or_log
 
@@ -49,15 +83,18 @@ class ErrorHandler:
             print(student_id + " " + msg)
             sys.exit(1)
         elif action == "log":
-            if not student_id in self.database.keys():
-                self.init_student(student_id)
-            self.database[student_id] += str(msg) + str("\n")
+            with self._lock:
+                if not student_id in self.database.keys():
+                    self.init_student(student_id)
+                self.database[student_id] += str(msg) + str("\n")
+                if len(self.database[student_id]) > max_len:
+                    self.database[student_id] = self.database[student_id][:max_len]
+            captured = _captured.get()
+            if captured is not None:
+                captured.append(msg)
             logging.error(
                 student_id + " " + msg[:max_len] if len(msg) > max_len else msg
             )
         else:
             print("Cannot handle `" + action + "`. Check ErrorHandler setting.")
             sys.exit(1)
-
-        if len(self.database[student_id]) > max_len:
-            self.database[student_id] = self.database[student_id][:max_len]
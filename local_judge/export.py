@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import csv
+import json
+import os
+
+from openpyxl import Workbook, load_workbook
+
+
+def read_sheets(path):
+    """Read the values of all worksheets of the workbook in read-only mode.
+
+    Return a list of `(title, rows)` where the active worksheet comes first.
+    """
+    book = load_workbook(path, read_only=True)
+    try:
+        active = book.active.title
+        sheets = [
+            (sheet.title, [list(row) for row in sheet.iter_rows(values_only=True)])
+            for sheet in book.worksheets
+        ]
+    finally:
+        book.close()
+    sheets.sort(key=lambda sheet: sheet[0] != active)
+    return sheets
+
+
+def write_xlsx(path, sheets):
+    """Write the rows of each `(title, rows)` into a write-only workbook."""
+    book = Workbook(write_only=True)
+    for title, rows in sheets:
+        sheet = book.create_sheet(title)
+        for row in rows:
+            sheet.append(row)
+    book.save(path)
+
+
+def write_csv(path, rows):
+    """Write the rows into a CSV file."""
+    with open(path, "w", newline="", encoding="utf8") as f:
+        csv.writer(f).writerows(rows)
+
+
+def write_jsonl(path, rows):
+    """Write the rows into a JSON lines file, keyed by the title row."""
+    rows = iter(rows)
+    title = next(rows, [])
+    with open(path, "w", encoding="utf8") as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(title, row)), ensure_ascii=False) + "\n")
+
+
+WRITERS = {
+    ".csv": write_csv,
+    ".jsonl": write_jsonl,
+}
+
+
+def is_supported(path):
+    """Check whether the rows can be exported to the file by its extension."""
+    return os.path.splitext(path)[1].lower() in WRITERS
+
+
+def write_rows(path, rows):
+    """Export the rows by the writer of the file extension."""
+    WRITERS[os.path.splitext(path)[1].lower()](path, rows)
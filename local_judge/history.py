@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import os
+
+from . import utils
+
+
+class TestHistory:
+    """The runs, failures and total wall time of each test across judgements.
+
+    It is kept in a JSON file, e.g. on a lab machine shared by the students,
+    to run the tests which fail most often and then the cheapest ones first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tests = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.tests = json.load(f)
+            except ValueError:
+                pass  # start again from a broken file
+
+    def stats(self):
+        """Return the failure rate and the mean wall time of each test."""
+        return {
+            name: (
+                test["failures"] / test["runs"],
+                test["time"] / test["timed_runs"] if test["timed_runs"] else None,
+            )
+            for name, test in self.tests.items()
+            if test["runs"]
+        }
+
+    def update(self, rows):
+        """Add the judged rows of the report table, where skipped tests are ignored."""
+        for row in rows:
+            if row.get("skipped"):
+                continue
+            test = self.tests.setdefault(
+                row["test"], {"runs": 0, "failures": 0, "time": 0.0, "timed_runs": 0}
+            )
+            test["runs"] += 1
+            test["failures"] += 0 if row["accept"] else 1
+            if row["usage"] is not None:
+                test["time"] += row["usage"].wall_time
+                test["timed_runs"] += 1
+
+    def save(self):
+        utils.atomic_write_json(self.path, self.tests)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import argparse
+import glob
+import json
+import os
+from collections import namedtuple
+
+from . import utils
+
+Test = namedtuple("Test", ("test_name", "input_filepath", "answer_filepath"))
+
+# The index of the tests paired with their answers; `missing` is the set of
+# the answer paths which were not found when the index was made
+TestIndex = namedtuple("TestIndex", ("tests", "missing"))
+
+
+def static_root(pattern):
+    """Get the longest leading directory of the pattern without wildcards
+
+    input/*/*.in -> input
+    """
+    parts = os.path.normpath(pattern).split(os.sep)
+    for i, part in enumerate(parts):
+        if glob.has_magic(part):
+            parts = parts[:i]
+            break
+    else:
+        parts = parts[:-1]
+    root = os.sep.join(parts)
+    if not root and pattern.startswith(os.sep):
+        root = os.sep
+    return os.path.abspath(root or os.curdir)
+
+
+def _mtimes(dirs):
+    mtimes = {}
+    for path in dirs:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtimes[path] = None
+    return mtimes
+
+
+def scan(inputs, ans_dir, ans_ext):
+    """Pair each input matched by the pattern with its answer, sorted by name."""
+    tests = []
+    for path in glob.iglob(inputs):
+        path = os.path.abspath(path)
+        name = utils.get_filename(path)
+        tests.append(Test(name, path, utils.expand_path(ans_dir, name, ans_ext)))
+    tests.sort(key=lambda t: t.test_name)
+    missing = {
+        t.answer_filepath for t in tests if not os.path.isfile(t.answer_filepath)
+    }
+    return TestIndex(tests, missing)
+
+
+def _watched_dirs(inputs, ans_dir, tests):
+    """The directories whose mtime changes when an input or answer is added or removed."""
+    dirs = {static_root(inputs), os.path.abspath(ans_dir)}
+    dirs.update(os.path.dirname(t.input_filepath) for t in tests)
+    dirs.update(os.path.dirname(t.answer_filepath) for t in tests)
+    return sorted(dirs)
+
+
+def load(inputs, ans_dir, ans_ext, cache_path=None):
+    """Get the index of the tests, which is cached in `cache_path` if given.
+
+    The cached index is used as long as the same pattern is matched from the
+    same directory and the mtimes of the directories of the inputs and the
+    answers are unchanged, so the inputs are not globbed again.
+    """
+    key = [os.getcwd(), inputs, ans_dir, ans_ext]
+    if cache_path is not None and os.path.isfile(cache_path):
+        try:
+            with open(cache_path) as f:
+                data = json.load(f)
+            if data["key"] == key and _mtimes(data["mtimes"]) == data["mtimes"]:
+                return TestIndex(
+                    [Test(*t) for t in data["tests"]], set(data["missing"])
+                )
+        except (ValueError, KeyError, TypeError):
+            pass  # rebuild a broken cache
+    index = scan(inputs, ans_dir, ans_ext)
+    if cache_path is not None:
+        data = {
+            "key": key,
+            "mtimes": _mtimes(_watched_dirs(inputs, ans_dir, index.tests)),
+            "tests": index.tests,
+            "missing": sorted(index.missing),
+        }
+        utils.atomic_write_json(cache_path, data)
+    return index
+
+
+def parse_shard(shard):
+    """Parse the 1-based shard of the tests
+
+    3/8 -> (3, 8)
+    """
+    try:
+        k, n = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid shard `{shard}`, expected K/N"
+        ) from None
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(
+            f"invalid shard `{shard}`, expected 1 <= K <= N"
+        )
+    return k, n
+
+
+def shard(tests, k, n):
+    """Take every n-th test from the k-th one, so the shards are balanced."""
+    return tests[k - 1 :: n]
@@ -34,25 +34,59 @@ if sys.version_info < (3,):
         + "Please use Python 3"
     )
 
-import re
+import tempfile
+import threading
 import time
-from subprocess import PIPE, Popen, TimeoutExpired
+from subprocess import PIPE, TimeoutExpired
 import os
-from glob import glob as globbing
-from collections import namedtuple
 import configparser
 import argparse
 import errno
-from shutil import copyfile, copymode
+from shutil import copyfile, copymode, rmtree
 import signal
 import json
+import selectors
+from statistics import median
+from concurrent.futures import ThreadPoolExecutor
 
 from . import utils
+from . import command
+from . import calibration
+from . import comparator
+from . import index
+from . import trace
+from .cache import BuildCache, ResultCache, hash_file, tree_stats
+from .compiler_cache import CompilerCache
+from .launcher import LauncherPool, make_request
+from .sandbox import Process, Usage, kill_process_group, killed_by, resource_limits
 from .error_handler import ErrorHandler
+from .history import TestHistory
+from .index import Test
 from .report import Report
 
 
-Test = namedtuple("Test", ("test_name", "input_filepath", "answer_filepath"))
+# The returncodes of the runs killed by the judge
+TLE_RETURNCODE = 124
+OLE_RETURNCODE = 153
+MLE_RETURNCODE = 137
+RUN_VERDICTS = {
+    TLE_RETURNCODE: "TLE: time limit exceeded",
+    OLE_RETURNCODE: "OLE: output limit exceeded",
+    MLE_RETURNCODE: "MLE: memory limit exceeded",
+}
+# The verdict of the tests which are not run after too many failures
+SKIPPED_VERDICT = "skipped after too many failures"
+# How often the size of the output and the peak memory are checked when
+# `OutputLimit` or `MemoryLimit` is set
+OUTPUT_POLL_INTERVAL = 0.02
+
+
+class OutputLimitExceeded(Exception):
+    pass
+
+
+class MemoryLimitExceeded(Exception):
+    pass
 
 
 class LocalJudge:
@@ -66,13 +100,26 @@ class LocalJudge:
             self.run_command = self._config["RunCommand"]
             self.temp_output_dir = self._config["TempOutputDir"]
             self.diff_command = self._config["DiffCommand"]
+            # Only used to show the differences when a built-in comparator is used
+            self.diff_render_command = self._config.get(
+                "DiffRenderCommand",
+                "git diff --no-index --color-words {answer} {output}",
+            )
             self.delete_temp_output = self._config["DeleteTempOutput"]
             self._ans_dir = self._config["AnswerDir"]
             self._ans_ext = self._config["AnswerExtension"]
             self.score_dict = self._config["ScoreDict"]
             self.timeout = self._config["Timeout"]
+            # Optional: the timeouts of the build and of each run
+            self.build_timeout = float(self._config.get("BuildTimeout", self.timeout))
+            self.run_timeout = float(self._config.get("RunTimeout", self.timeout))
             # tests contains corresponding input and answer path
-            self.tests = self.inputs_to_tests(self._config["Inputs"])
+            self._missing_answers = set()
+            self.set_tests(
+                self.inputs_to_tests(
+                    self._config["Inputs"], self._config.get("TestIndexFile")
+                )
+            )
         except KeyError as e:
             self.error_handler.handle(
                 str(e)
@@ -80,6 +127,100 @@ class LocalJudge:
                 + "Please check `judge.conf` first.",
                 exit_or_log="exit",
             )
+        # file: write the output into `TempOutputDir` and compare the file
+        # pipe: compare the output from the pipe while the program is running
+        # launcher: same as file, but started by a persistent launcher process
+        self.run_mode = self._config.get("RunMode", "file")
+        if self.run_mode not in ("file", "pipe", "launcher"):
+            self.error_handler.handle(
+                "Unknown `RunMode = "
+                + self.run_mode
+                + "`. Available: file, pipe, launcher. "
+                + "Please check `judge.conf` first.",
+                exit_or_log="exit",
+            )
+        self._launchers = LauncherPool() if self.run_mode == "launcher" else None
+        if self.run_mode == "pipe" and not comparator.is_builtin(self.diff_command):
+            self.error_handler.handle(
+                "`RunMode = pipe` needs a built-in comparator for `DiffCommand`, "
+                + "such as `builtin:exact`. Please check `judge.conf` first.",
+                exit_or_log="exit",
+            )
+        # Optional: kill the program once its output is larger than the limit
+        self.output_limit = None
+        if self._config.get("OutputLimit"):
+            self.output_limit = utils.parse_size(self._config["OutputLimit"])
+        # Optional: the resource limits applied to each test case
+        self.memory_limit = None
+        if self._config.get("MemoryLimit"):
+            self.memory_limit = utils.parse_size(self._config["MemoryLimit"])
+        self.cpu_time_limit = None
+        if self._config.get("CpuTimeLimit"):
+            self.cpu_time_limit = float(self._config["CpuTimeLimit"])
+        self.process_limit = None
+        if self._config.get("ProcessLimit"):
+            self.process_limit = int(self._config["ProcessLimit"])
+        # Optional: read the peak memory of each program, for which it is
+        # traced; it is always read to check `MemoryLimit`
+        self.measure_memory = (
+            self._config.get("MeasureMemory", "true") == "true"
+            or self.memory_limit is not None
+        )
+        # Optional: the timeout of each test derived from the baseline wall
+        # time of the reference solution, which is made by `judge --calibrate`
+        self.timeout_file = self._config.get("TimeoutFile")
+        self.timeout_factor = float(self._config.get("TimeoutFactor", "3"))
+        self.timeout_floor = float(self._config.get("TimeoutFloor", "1"))
+        self.test_timeouts = {}
+        if self.timeout_file:
+            self.test_timeouts = calibration.timeouts(
+                calibration.load(self.timeout_file),
+                self.timeout_factor,
+                self.timeout_floor,
+            )
+        # Optional: rerun the accepted tests to get the median of the usages
+        self.repeat = int(self._config.get("Repeat", "1"))
+        # Optional: skip the build when the same source tree was built before
+        self.build_cache = None
+        if self._config.get("BuildCacheDir"):
+            self.build_cache = BuildCache(
+                self._config["BuildCacheDir"],
+                utils.parse_size(self._config.get("BuildCacheSize", "1G")),
+            )
+        # Optional: share the compiled translation units among the builds
+        self.compiler_cache = None
+        if self._config.get("CompilerCacheDir"):
+            self.compiler_cache = CompilerCache(
+                self._config["CompilerCacheDir"],
+                utils.parse_size(self._config.get("CompilerCacheSize", "1G")),
+            )
+        # Optional: skip the tests whose verdict is known from the previous runs
+        self.result_cache = None
+        if self._config.get("ResultCacheFile"):
+            self.result_cache = ResultCache(self._config["ResultCacheFile"])
+        # The hashes and modes of inputs and answers, shared by all students
+        self._file_hashes = {}
+        self._file_modes = {}
+        # Optional: the directory of the scratch directories of the students,
+        # which may be on a tmpfs such as /dev/shm
+        self.scratch_dir = self._config.get("ScratchDir", self.temp_output_dir)
+        # The scratch directory of each student in this run
+        self._scratch_paths = {}
+        if (
+            comparator.is_builtin(self.diff_command)
+            and comparator.get_builtin_name(self.diff_command)
+            not in comparator.COMPARATORS
+        ):
+            self.error_handler.handle(
+                "Unknown built-in comparator `"
+                + self.diff_command
+                + "`. Available: "
+                + ", ".join(
+                    comparator.BUILTIN_PREFIX + name for name in comparator.COMPARATORS
+                )
+                + ". Please check `judge.conf` first.",
+                exit_or_log="exit",
+            )
         try:
             # Create the temporary directory for output
             # Suppress the error when the directory already exists
@@ -88,47 +229,101 @@ class LocalJudge:
             if e.errno != errno.EEXIST:
                 self.error_handler.handle(str(e))
 
-    def inputs_to_tests(self, inputs):
-        inputs_path = [os.path.abspath(path) for path in globbing(inputs)]
+    def inputs_to_tests(self, inputs, cache_path=None):
+        """Pair the inputs with the answers, sorted by the test name.
 
-        ret = [
-            Test(
-                utils.get_filename(path),
-                path,
-                utils.expand_path(
-                    self._ans_dir, utils.get_filename(path), self._ans_ext
-                ),
-            )
-            for path in inputs_path
-        ]
-        ret.sort(key=lambda t: t.test_name)
-        return ret
+        The answers are checked here once instead of for each student. With
+        `cache_path` given, the index is cached until the directories of the
+        inputs or the answers are changed.
+        """
+        test_index = index.load(inputs, self._ans_dir, self._ans_ext, cache_path)
+        self._missing_answers |= test_index.missing
+        return test_index.tests
+
+    def set_tests(self, tests):
+        """Replace the tests, and run them in the given order."""
+        self.tests = tests
+        # The indices of the tests in the order to run
+        self.test_order = list(range(len(self.tests)))
+
+    def shard(self, k, n):
+        """Only keep the k-th of n shards of the tests."""
+        self.set_tests(index.shard(self.tests, k, n))
+
+    def prioritize(self, stats):
+        """Run the tests which fail most often first, and then the cheapest ones.
+
+        `stats` maps the test name to its failure rate and mean wall time,
+        where the tests without stats are run last in name order.
+        """
+        inf = float("inf")
+
+        def priority(i):
+            failure_rate, mean_time = stats.get(self.tests[i].test_name, (0, None))
+            return -failure_rate, inf if mean_time is None else mean_time, i
+
+        self.test_order = sorted(range(len(self.tests)), key=priority)
+
+    def _has_answer(self, answer_filepath):
+        return answer_filepath not in self._missing_answers
 
     def build(self, student_id="local", cwd="./"):
-        """Build the executable which needs to be judged."""
-        err = ""
-        process = Popen(
-            self.build_command,
+        """Build the executable which needs to be judged.
+
+        If `BuildCacheDir` is set, the executable is restored from the cache
+        instead when the source tree has been built before.
+        """
+        with trace.span("build", student_id=student_id):
+            self._build(student_id, cwd)
+
+    def _build(self, student_id, cwd):
+        err = b""
+        cache_key = None
+        before = None
+        if self.build_cache is not None:
+            cache_key = self.build_cache.key(cwd, self.build_command, self.executable)
+            if self.build_cache.restore(cache_key, cwd + self.executable):
+                return
+            before = tree_stats(cwd)
+        process = command.parse(self.build_command).popen(
+            {},
+            cwd=cwd,
             stdout=PIPE,
             stderr=PIPE,
-            shell=True,
-            executable="bash",
-            cwd=cwd,
             start_new_session=True,
+            env=self.build_env,
         )
         try:
-            _, err = process.communicate(timeout=float(self.timeout))
+            _, err = process.communicate(timeout=self.build_timeout)
         except TimeoutExpired:
-            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            # Ref: https://stackoverflow.com/a/44705997
+            kill_process_group(process)
             self.error_handler.handle(
                 f"TLE at build stage; kill `{self.build_command}`",
                 student_id=student_id,
             )
         except KeyboardInterrupt:
-            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+            kill_process_group(process)
             raise KeyboardInterrupt from None
-        if process.returncode != 0:
+        self._check_build(process.returncode, err, student_id, cwd, cache_key, before)
+
+    @property
+    def build_env(self):
+        """The environment of the build, or None to inherit this process's."""
+        return None if self.compiler_cache is None else self.compiler_cache.env
+
+    def test_timeout(self, input_filepath):
+        """Get the timeout of the run of the input, calibrated or `RunTimeout`."""
+        return self.test_timeouts.get(
+            utils.get_filename(input_filepath), self.run_timeout
+        )
+
+    def _check_build(self, returncode, err, student_id, cwd, cache_key, before=None):
+        """Log the failure of the build, or cache the executable if it succeeded.
+
+        `before` is the `tree_stats` of the source tree before the build, by
+        which the outputs of the build are left out of the cache key.
+        """
+        if returncode != 0:
             self.error_handler.handle(
                 "Failed in build stage. Error message:\n\n"
                 + str(err, encoding="utf8")
@@ -146,56 +341,369 @@ class LocalJudge:
                 + "Please check `Makefile` first.",
                 student_id=student_id,
             )
+        elif cache_key is not None and returncode == 0:
+            self.build_cache.store(cache_key, cwd + self.executable)
+            self.build_cache.record_outputs(cwd, before)
 
-    def run(self, input_filepath, student_id="local", with_timestamp=True, cwd="./"):
+    def run(self, input_filepath, student_id="local", cwd="./"):
         """Run the executable with input.
 
-        The output will be temporarily placed in specific location,
-        and the path will be returned for the validation.
+        The output will be temporarily placed in the scratch directory of the
+        student, and the path will be returned for the validation. The
+        resource usage of the program is returned as well.
         """
+        with trace.span(
+            "run", student_id=student_id, test=utils.get_filename(input_filepath)
+        ):
+            return self._run(input_filepath, student_id, cwd)
+
+    def _run(self, input_filepath, student_id, cwd):
         if not os.path.isfile(cwd + self.executable):
-            return 1, "no_executable_to_run"
-        output_filepath = os.path.join(
-            self.temp_output_dir, utils.get_filename(input_filepath)
-        )
-        if with_timestamp:
-            output_filepath += student_id + "_" + str(int(time.time()))
-        output_filepath += self._ans_ext
-        cmd = self.run_command
-        cmd = re.sub(r"{input}", input_filepath, cmd)
-        cmd = re.sub(r"{output}", output_filepath, cmd)
-        process = Popen(
-            cmd,
+            return 1, "no_executable_to_run", None
+        output_filepath = self._output_filepath(input_filepath, student_id)
+        cmd, fields = self._run_cmd(input_filepath, output_filepath)
+        if self.run_mode == "launcher" and not cmd.shell:
+            launched = self._run_launched(
+                cmd, fields, input_filepath, output_filepath, student_id, cwd
+            )
+            if launched is not None:
+                return launched
+        start_time = time.monotonic()
+        process = cmd.popen(
+            fields,
+            cwd=cwd,
+            popen_class=Process,
             stdout=PIPE,
             stderr=PIPE,
-            shell=True,
-            executable="bash",
-            cwd=cwd,
             start_new_session=True,
+            limits=self._resource_limits(),
+            trace=self.measure_memory,
         )
+        err = b""
         try:
-            _, err = process.communicate(timeout=float(self.timeout))
+            err = self._wait_for_run(
+                process, output_filepath, self.test_timeout(input_filepath)
+            )
+            returncode = process.returncode
         except TimeoutExpired:
-            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            # Ref: https://stackoverflow.com/a/44705997
+            kill_process_group(process)
+            returncode = TLE_RETURNCODE
+        except OutputLimitExceeded:
+            kill_process_group(process, grace_period=0)
+            returncode = OLE_RETURNCODE
+        except MemoryLimitExceeded:
+            kill_process_group(process, grace_period=0)
+            returncode = MLE_RETURNCODE
+        except KeyboardInterrupt:
+            kill_process_group(process)
+            raise KeyboardInterrupt from None
+        usage = process.usage(time.monotonic() - start_time)
+        returncode = self._check_run(
+            returncode, err, usage, input_filepath, cmd.render(**fields), student_id
+        )
+        return returncode, output_filepath, usage
+
+    def _run_launched(
+        self, cmd, fields, input_filepath, output_filepath, student_id, cwd
+    ):
+        """Run the executable by the launcher of this thread.
+
+        Return None if the launcher cannot start it, so that it is run in
+        the usual way and the error is reported as usual.
+        """
+        argv, redirections = cmd.expand(fields, cwd)
+        stdout, stdout_mode = redirections.get("stdout", (None, "wb"))
+        response = self._launchers.launch(
+            make_request(
+                argv,
+                cwd,
+                stdin=redirections.get("stdin", (None,))[0],
+                stdout=stdout,
+                stdout_mode=stdout_mode,
+                timeout=self.test_timeout(input_filepath),
+                output_limit=self.output_limit,
+                memory_limit=self.memory_limit,
+                limits=self._resource_limits(),
+                trace=self.measure_memory,
+            )
+        )
+        if "error" in response:
+            return None
+        returncode = {
+            "TLE": TLE_RETURNCODE,
+            "OLE": OLE_RETURNCODE,
+            "MLE": MLE_RETURNCODE,
+        }.get(response["verdict"], response["returncode"])
+        usage = Usage(response["wall_time"], response["cpu_time"], response["max_rss"])
+        returncode = self._check_run(
+            returncode,
+            response["err"],
+            usage,
+            input_filepath,
+            cmd.render(**fields),
+            student_id,
+        )
+        return returncode, output_filepath, usage
+
+    def _output_filepath(self, input_filepath, student_id):
+        return os.path.join(
+            self.scratch_path(student_id),
+            utils.get_filename(input_filepath) + self._ans_ext,
+        )
+
+    def scratch_path(self, student_id):
+        """Get the private directory of the outputs of the student.
+
+        The directory is made by mkdtemp once in this run and shared by all
+        tests of the student, so two runs judging the same student at once,
+        e.g. `ta_judge -s` beside a full run, never share their outputs.
+        """
+        path = self._scratch_paths.get(student_id)
+        if path is None:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            path = tempfile.mkdtemp(prefix=student_id + "-", dir=self.scratch_dir)
+            self._scratch_paths[student_id] = path
+        return path
+
+    def clean_scratch(self, student_id):
+        """Remove the outputs of the student at once if `DeleteTempOutput` is true."""
+        if self.delete_temp_output != "true":
+            return
+        path = self._scratch_paths.pop(student_id, None)
+        if path is not None:
+            rmtree(path, ignore_errors=True)
+
+    def close(self):
+        """Stop the launchers of `RunMode = launcher`."""
+        if self._launchers is not None:
+            self._launchers.close()
+
+    def _run_cmd(self, input_filepath, output_filepath):
+        """Return the parsed run command and its fields."""
+        fields = {"input": input_filepath, "output": output_filepath}
+        return command.parse(self.run_command), fields
+
+    def _resource_limits(self):
+        return resource_limits(**self._limits())
+
+    def _limits(self):
+        return {
+            "memory_limit": self.memory_limit,
+            "cpu_time_limit": self.cpu_time_limit,
+            "process_limit": self.process_limit,
+            "file_size_limit": self.output_limit,
+        }
+
+    def _check_run(self, returncode, err, usage, input_filepath, cmd, student_id):
+        """Log the failure of the run and return the returncode of its verdict.
+
+        The kills caused by the resource limits are mapped to TLE and OLE, and
+        a run whose peak memory is over `MemoryLimit` is judged as MLE.
+        """
+        if returncode in RUN_VERDICTS:
+            pass
+        elif killed_by(returncode, signal.SIGXCPU) or (
+            self.cpu_time_limit is not None
+            and killed_by(returncode, signal.SIGKILL)
+            and usage.cpu_time is not None
+            and usage.cpu_time >= self.cpu_time_limit
+        ):
+            returncode = TLE_RETURNCODE
+        elif killed_by(returncode, signal.SIGXFSZ):
+            returncode = OLE_RETURNCODE
+        elif self._over_memory_limit(usage.max_rss):
+            returncode = MLE_RETURNCODE
+        if returncode in RUN_VERDICTS:
             self.error_handler.handle(
-                f"TLE at {utils.get_filename(input_filepath)}; kill `{cmd}`",
+                f"{RUN_VERDICTS[returncode][:3]} at "
+                + f"{utils.get_filename(input_filepath)}; kill `{cmd}`",
                 student_id=student_id,
             )
-            process.returncode = 124
-            return process.returncode, output_filepath
-        except KeyboardInterrupt:
-            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            raise KeyboardInterrupt from None
-        if process.returncode != 0:
+        elif returncode != 0:
             self.error_handler.handle(
                 "Failed in run stage. Error message:\n\n"
-                + str(err, encoding="utf8")
+                + str(err, encoding="utf8", errors="ignore")
                 + "\n"
                 + "Please check `your program` first.",
                 student_id=student_id,
             )
-        return process.returncode, output_filepath
+        return returncode
+
+    def _over_memory_limit(self, max_rss):
+        return (
+            self.memory_limit is not None
+            and max_rss is not None
+            and max_rss * 1024 > self.memory_limit
+        )
+
+    def _check_memory(self, process):
+        """Raise `MemoryLimitExceeded` if the running program uses too much memory."""
+        if self._over_memory_limit(process.peak_rss()):
+            raise MemoryLimitExceeded()
+
+    def _wait_for_run(self, process, output_filepath, timeout):
+        """Wait for the program and return its stderr.
+
+        If `OutputLimit` or `MemoryLimit` is set, the size of the output file
+        and the peak memory are checked while the program is running, and
+        `OutputLimitExceeded` or `MemoryLimitExceeded` is raised as soon as
+        either is over its limit.
+        """
+        if self.output_limit is None and self.memory_limit is None:
+            _, err = process.communicate(timeout=timeout)
+            return err
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                # Retrying communicate() after its timeout does not lose output
+                _, err = process.communicate(
+                    timeout=max(min(OUTPUT_POLL_INTERVAL, remaining), 0)
+                )
+                return err
+            except TimeoutExpired:
+                if remaining <= OUTPUT_POLL_INTERVAL:
+                    raise
+            self._check_memory(process)
+            if self.output_limit is None:
+                continue
+            try:
+                output_size = os.path.getsize(output_filepath)
+            except FileNotFoundError:
+                output_size = 0
+            if output_size > self.output_limit:
+                raise OutputLimitExceeded(output_filepath)
+
+    def run_piped(
+        self,
+        input_filepath,
+        answer_filepath,
+        student_id="local",
+        cwd="./",
+        render_diff=True,
+    ):
+        """Run the executable with input and compare its output from the pipe.
+
+        No output file is written. The output is compared with the
+        memory-mapped answer as it is produced, and the program is killed as
+        soon as the output mismatches, unless the diff needs to be rendered.
+        Return the returncode, the accept, the diff result, and the resource
+        usage of the program.
+        """
+        with trace.span(
+            "run", student_id=student_id, test=utils.get_filename(input_filepath)
+        ):
+            return self._run_piped(
+                input_filepath, answer_filepath, student_id, cwd, render_diff
+            )
+
+    def _run_piped(self, input_filepath, answer_filepath, student_id, cwd, render_diff):
+        if not os.path.isfile(cwd + self.executable):
+            return 1, False, "no_executable_to_run", None
+        if not self._has_answer(answer_filepath):
+            self.error_handler.handle(
+                "There was no any corresponding answer `"
+                + answer_filepath
+                + "`. Did you set the `AnswerDir` correctly? "
+                + "Please check `judge.conf` first.",
+                student_id=student_id,
+            )
+            return 1, False, "no_answer_file", None
+        cmd, fields = self._run_cmd(input_filepath, "/dev/stdout")
+        with comparator.map_answer(answer_filepath) as answer:
+            stream = comparator.compare_stream(self.diff_command, answer)
+            matched = True
+            output = bytearray()  # only kept for rendering the diff
+            err = bytearray()
+            start_time = time.monotonic()
+            process = cmd.popen(
+                fields,
+                cwd=cwd,
+                popen_class=Process,
+                stdout=PIPE,
+                stderr=PIPE,
+                start_new_session=True,
+                limits=self._resource_limits(),
+                trace=self.measure_memory,
+            )
+            selector = selectors.DefaultSelector()
+            selector.register(process.stdout, selectors.EVENT_READ)
+            selector.register(process.stderr, selectors.EVENT_READ)
+            output_size = 0
+            timeout = self.test_timeout(input_filepath)
+            deadline = start_time + timeout
+            # Wake up to check the peak memory if `MemoryLimit` is set
+            interval = None if self.memory_limit is None else OUTPUT_POLL_INTERVAL
+            try:
+                while selector.get_map():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutExpired(cmd.template, timeout)
+                    if interval is not None:
+                        self._check_memory(process)
+                        remaining = min(remaining, interval)
+                    for key, _ in selector.select(remaining):
+                        data = os.read(key.fd, comparator.CHUNK_SIZE)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                        elif key.fileobj is process.stderr:
+                            err += data
+                        else:
+                            output_size += len(data)
+                            if (
+                                self.output_limit is not None
+                                and output_size > self.output_limit
+                            ):
+                                raise OutputLimitExceeded("/dev/stdout")
+                            if render_diff:
+                                output += data
+                            matched = matched and stream.feed(data)
+                    if not matched and (
+                        not render_diff or len(output) > 2 * len(answer) + 1024
+                    ):
+                        # Early exit: the rest of the output does not matter
+                        kill_process_group(process, grace_period=0)
+                        break
+                process.wait(timeout=max(deadline - time.monotonic(), 0))
+                returncode = process.returncode
+            except TimeoutExpired:
+                kill_process_group(process)
+                returncode = TLE_RETURNCODE
+            except OutputLimitExceeded:
+                kill_process_group(process, grace_period=0)
+                returncode = OLE_RETURNCODE
+            except MemoryLimitExceeded:
+                kill_process_group(process, grace_period=0)
+                returncode = MLE_RETURNCODE
+            except KeyboardInterrupt:
+                kill_process_group(process)
+                raise KeyboardInterrupt from None
+            finally:
+                selector.close()
+                process.stdout.close()
+                process.stderr.close()
+            usage = process.usage(time.monotonic() - start_time)
+            if not matched and returncode not in RUN_VERDICTS:
+                # Killed by the judge because of the wrong answer
+                diff = ""
+                if render_diff:
+                    diff = comparator.render_diff(answer, output, answer_filepath)
+                return returncode, False, diff, usage
+            returncode = self._check_run(
+                returncode,
+                bytes(err),
+                usage,
+                input_filepath,
+                cmd.render(**fields),
+                student_id,
+            )
+            if returncode != 0:
+                return returncode, False, RUN_VERDICTS.get(returncode, ""), usage
+            accept = stream.finish()
+            diff = ""
+            if not accept and render_diff:
+                diff = comparator.render_diff(answer, output, answer_filepath)
+        return returncode, accept, diff, usage
 
     def compare(
         self,
@@ -204,14 +712,69 @@ class LocalJudge:
         run_returncode,
         student_id="local",
         cwd="./",
+        render_diff=True,
     ):
         """Verify the differences between output and answer.
 
         If the files are identical, the accept will be set to True.
-        Another return value is the diff result.
+        Another return value is the diff result. When a built-in comparator
+        is used, the `DiffRenderCommand` is only launched for rejected outputs
+        if `render_diff` is set.
         """
+        with trace.span(
+            "compare", student_id=student_id, test=utils.get_filename(answer_filepath)
+        ):
+            return self._compare(
+                output_filepath,
+                answer_filepath,
+                run_returncode,
+                student_id,
+                cwd,
+                render_diff,
+            )
+
+    def _compare(
+        self,
+        output_filepath,
+        answer_filepath,
+        run_returncode,
+        student_id,
+        cwd,
+        render_diff,
+    ):
+        checked = self._check_output(
+            output_filepath, answer_filepath, run_returncode, student_id
+        )
+        if checked is not None:
+            return checked
+        if comparator.is_builtin(self.diff_command):
+            accept = comparator.compare(
+                self.diff_command, output_filepath, answer_filepath
+            )
+            diff = ""
+            if not accept and render_diff:
+                _, diff = self._diff(
+                    self.diff_render_command,
+                    output_filepath,
+                    answer_filepath,
+                    student_id,
+                    cwd,
+                )
+        else:
+            accept, diff = self._diff(
+                self.diff_command, output_filepath, answer_filepath, student_id, cwd
+            )
+        return accept, diff
+
+    def _check_output(
+        self, output_filepath, answer_filepath, run_returncode, student_id
+    ):
+        """Return the verdict if the output cannot be compared, otherwise None."""
         if run_returncode != 0:
-            return False, ""
+            # Do not leave the partial output, which may be large after OLE
+            if self.delete_temp_output == "true" and os.path.isfile(output_filepath):
+                os.remove(output_filepath)
+            return False, RUN_VERDICTS.get(run_returncode, "")
         if output_filepath == "no_executable_to_run":
             return False, output_filepath
         if not os.path.isfile(output_filepath):
@@ -222,7 +785,7 @@ class LocalJudge:
                 student_id=student_id,
             )
             return False, "no_output_file"
-        if not os.path.isfile(answer_filepath):
+        if not self._has_answer(answer_filepath):
             self.error_handler.handle(
                 "There was no any corresponding answer `"
                 + answer_filepath
@@ -231,24 +794,41 @@ class LocalJudge:
                 student_id=student_id,
             )
             return False, "no_answer_file"
-        # Sync the file mode
-        copymode(answer_filepath, output_filepath)
-        answer_filepath = '"{}"'.format(answer_filepath)
-        cmd = re.sub(r"{output}", output_filepath, self.diff_command)
-        cmd = re.sub(r"{answer}", answer_filepath, cmd)
-        process = Popen(
-            cmd,
-            stdout=PIPE,
-            stderr=PIPE,
-            shell=True,
-            executable="bash",
-            cwd=cwd,
+        return None
+
+    def _diff(self, diff_command, output_filepath, answer_filepath, student_id, cwd):
+        """Run the external diff tool and return whether the files are identical."""
+        cmd, fields = self._diff_cmd(diff_command, output_filepath, answer_filepath)
+        process = cmd.popen(
+            fields, cwd=cwd, stdout=PIPE, stderr=PIPE, start_new_session=True
         )
         try:
-            out, err = process.communicate()
+            out, err = process.communicate(timeout=float(self.timeout))
+        except TimeoutExpired:
+            kill_process_group(process)
+            self.error_handler.handle(
+                f"TLE at compare stage; kill `{cmd.render(**fields)}`",
+                student_id=student_id,
+            )
+            return False, ""
         except KeyboardInterrupt:
-            process.kill()
+            kill_process_group(process)
             raise KeyboardInterrupt from None
+        return self._check_diff(process.returncode, out, err, student_id)
+
+    def _diff_cmd(self, diff_command, output_filepath, answer_filepath):
+        """Return the parsed diff command and its fields."""
+        # Sync the executable bits, which are reported by `git diff`
+        if (
+            self._file_mode(answer_filepath) ^ os.stat(output_filepath).st_mode
+        ) & 0o111:
+            copymode(answer_filepath, output_filepath)
+        cmd = command.parse(diff_command)
+        if cmd.shell:
+            answer_filepath = '"{}"'.format(answer_filepath)
+        return cmd, {"output": output_filepath, "answer": answer_filepath}
+
+    def _check_diff(self, returncode, out, err, student_id):
         # If there is difference between two files, the return code is not 0
         if str(err, encoding="utf8").strip() != "":
             self.error_handler.handle(
@@ -256,11 +836,222 @@ class LocalJudge:
                 + str(err, encoding="utf8"),
                 student_id=student_id,
             )
-        if self.delete_temp_output == "true":
-            os.remove(output_filepath)
-        accept = process.returncode == 0
+        accept = returncode == 0
         return accept, str(out, encoding="utf8", errors="ignore")
 
+    def _file_mode(self, path):
+        if not path in self._file_modes:
+            self._file_modes[path] = os.stat(path).st_mode
+        return self._file_modes[path]
+
+    def _hash_file(self, path):
+        if not path in self._file_hashes:
+            self._file_hashes[path] = hash_file(path).hexdigest()
+        return self._file_hashes[path]
+
+    def _result_key(self, test, executable_hash):
+        """Get the key of the result cache, or None if the test cannot be cached."""
+        if executable_hash is None or not self._has_answer(test.answer_filepath):
+            return None
+        return ResultCache.key(
+            executable_hash,
+            self._hash_file(test.input_filepath),
+            self._hash_file(test.answer_filepath),
+            self.run_command,
+            self.diff_command,
+            str(self.test_timeout(test.input_filepath)),
+            # The verdict also depends on the resource limits of the run
+            str(sorted(self._limits().items())),
+        )
+
+    def judging_key(self):
+        """Hash everything but the submissions which decides the results.
+
+        That is the inputs and the answers of the tests, and the config of the
+        build, the runs, and the comparisons.
+        """
+        fields = [
+            self.build_command,
+            self.executable,
+            self.run_command,
+            self.run_mode,
+            self.diff_command,
+            str(self.build_timeout),
+            str(self.timeout),
+            str(sorted(self._limits().items())),
+        ]
+        for test in self.tests:
+            fields.append(test.test_name)
+            fields.append(self._hash_file(test.input_filepath))
+            if self._has_answer(test.answer_filepath):
+                fields.append(self._hash_file(test.answer_filepath))
+            else:
+                fields.append("")
+            fields.append(str(self.test_timeout(test.input_filepath)))
+        return ResultCache.key(*fields)
+
+    def executable_hash(self, cwd="./"):
+        """Hash the executable for the result cache, or None if it is not needed."""
+        if self.result_cache is None or not os.path.isfile(cwd + self.executable):
+            return None
+        return hash_file(cwd + self.executable).hexdigest()
+
+    def judge_test(
+        self,
+        test,
+        student_id="local",
+        cwd="./",
+        render_diff=True,
+        executable_hash=None,
+    ):
+        """Run and compare one test, and return the row for the report table.
+
+        With `ResultCacheFile` set and the hash of the executable given, the
+        test is not run if its verdict has been cached, and the errors logged
+        with the verdict are logged again.
+        """
+        cache_key, row = self._cached_row(
+            test, executable_hash, render_diff, student_id
+        )
+        if row is not None:
+            return row
+        with self.error_handler.capture() as errors:
+            if self.run_mode == "pipe":
+                returncode, accept, diff, usage = self.run_piped(
+                    test.input_filepath,
+                    test.answer_filepath,
+                    student_id=student_id,
+                    cwd=cwd,
+                    render_diff=render_diff,
+                )
+            else:
+                returncode, output_filepath, usage = self.run(
+                    test.input_filepath, student_id=student_id, cwd=cwd
+                )
+                accept, diff = self.compare(
+                    output_filepath,
+                    test.answer_filepath,
+                    returncode,
+                    student_id=student_id,
+                    cwd=cwd,
+                    render_diff=render_diff,
+                )
+        # TLE depends on the load of the machine, so it is not cached
+        if cache_key is not None and returncode != TLE_RETURNCODE:
+            self.result_cache.put(cache_key, accept, diff, errors)
+        if accept and self.repeat > 1:
+            usage = self._repeat_usage(test, usage, student_id, cwd)
+        return {
+            "test": test.test_name,
+            "accept": accept,
+            "diff": diff,
+            "usage": usage,
+        }
+
+    def _cached_row(self, test, executable_hash, render_diff, student_id):
+        """Return the key of the result cache and the cached row if there is one.
+
+        The errors cached with the row are logged again for the student.
+        """
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self._result_key(test, executable_hash)
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            # Rerun when the diff is needed but not rendered in the cached run
+            if cached is not None and (cached[0] or cached[1] or not render_diff):
+                accept, diff, errors = cached
+                for msg in errors:
+                    self.error_handler.handle(msg, student_id=student_id)
+                return cache_key, {
+                    "test": test.test_name,
+                    "accept": accept,
+                    "diff": diff,
+                    "usage": None,
+                }
+        return cache_key, None
+
+    def _repeat_usage(self, test, usage, student_id, cwd):
+        """Rerun the test and return the median of each field of the usages.
+
+        Only the usages are taken from the reruns; the verdict is not changed.
+        """
+        usages = [usage]
+        for _ in range(self.repeat - 1):
+            if self.run_mode == "pipe":
+                returncode, _, _, usage = self.run_piped(
+                    test.input_filepath,
+                    test.answer_filepath,
+                    student_id=student_id,
+                    cwd=cwd,
+                    render_diff=False,
+                )
+            else:
+                returncode, _, usage = self.run(
+                    test.input_filepath, student_id=student_id, cwd=cwd
+                )
+            if returncode == 0:
+                usages.append(usage)
+        return Usage(
+            *(None if None in values else median(values) for values in zip(*usages))
+        )
+
+    def judge_tests(
+        self,
+        student_id="local",
+        cwd="./",
+        jobs=1,
+        render_diff=True,
+        max_failures=None,
+    ):
+        """Judge all tests and return the rows in the same order as `self.tests`.
+
+        The tests are run in the order of `self.test_order`, concurrently on
+        a thread pool when `jobs` is more than 1. Each test writes to its own
+        output file, so the tests share no state. Once `max_failures` tests
+        are rejected, the tests which have not started are skipped.
+        """
+        executable_hash = self.executable_hash(cwd)
+        # Made before the threads, which would race to make it
+        self.scratch_path(student_id)
+        failures = [0]
+        lock = threading.Lock()
+
+        def judge_test(i):
+            test = self.tests[i]
+            if max_failures is not None:
+                with lock:
+                    if failures[0] >= max_failures:
+                        return skipped_row(test)
+            row = self.judge_test(test, student_id, cwd, render_diff, executable_hash)
+            if not row["accept"]:
+                with lock:
+                    failures[0] += 1
+            return row
+
+        rows = [None] * len(self.tests)
+        if jobs <= 1:
+            for i in self.test_order:
+                rows[i] = judge_test(i)
+            return rows
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for i, row in zip(
+                self.test_order, executor.map(judge_test, self.test_order)
+            ):
+                rows[i] = row
+        return rows
+
+
+def skipped_row(test):
+    """The row of the report table of a test which is not run."""
+    return {
+        "test": test.test_name,
+        "accept": False,
+        "diff": SKIPPED_VERDICT,
+        "usage": None,
+        "skipped": True,
+    }
+
 
 def get_args():
     """Init argparser and return the args from cli."""
@@ -289,13 +1080,67 @@ def get_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "--calibrate",
+        help="run the reference solution N times per test and save the baseline "
+        + "wall times into `TimeoutFile` without judgement",
+        type=int,
+        metavar="N",
+        default=None,
+    )
+    parser.add_argument(
+        "--test-jobs",
+        help="number of tests to run concurrently",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max-failures",
+        help="skip the remaining tests after K tests are rejected",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--fail-fast",
+        help="skip the remaining tests after the first rejected test, "
+        + "the same as `--max-failures 1`",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prioritize",
+        help="run the tests which fail most often and then the cheapest ones first, "
+        + "by the history in `TestHistoryFile`",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard",
+        help="only judge the K-th of N shards of the tests, e.g. 3/8",
+        type=index.parse_shard,
+        default=None,
+    )
     return parser.parse_args()
 
 
-def judge_all_tests(judge: LocalJudge, verbose_level, score_dict, total_score):
+def print_compiler_cache_stats(judge: LocalJudge):
+    """Print the hits and misses of the compiler cache in this run."""
+    if judge.compiler_cache is not None:
+        hits, misses = judge.compiler_cache.pop_stats()
+        print(f"Compiler cache: {hits} hits, {misses} misses")
+
+
+def judge_all_tests(
+    judge: LocalJudge,
+    verbose_level,
+    score_dict,
+    total_score,
+    test_jobs=1,
+    max_failures=None,
+    history=None,
+):
     """Judge all tests for given program.
 
-    If `--input` is set, there is only one input in this judgement.
+    If `--input` is set, there is only one input in this judgement. The
+    judged tests are added to the history if it is given.
     """
 
     judge.build()
@@ -303,14 +1148,65 @@ def judge_all_tests(judge: LocalJudge, verbose_level, score_dict, total_score):
     report = Report(
         report_verbose=verbose_level, score_dict=score_dict, total_score=total_score
     )
-    for test in judge.tests:
-        returncode, output_filepath = judge.run(test.input_filepath)
-        accept, diff = judge.compare(output_filepath, test.answer_filepath, returncode)
-        report.table.append({"test": test.test_name, "accept": accept, "diff": diff})
+    report.table = judge.judge_tests(
+        jobs=test_jobs,
+        render_diff=int(verbose_level) > 0,
+        max_failures=max_failures,
+    )
+    judge.clean_scratch("local")
+    if history is not None:
+        history.update(report.table)
+        history.save()
     return report.print_report()
 
 
-def copy_output_to_dir(judge: LocalJudge, output_dir, delete_temp_output, ans_ext):
+def calibrate(judge: LocalJudge, runs):
+    """Run the reference solution `runs` times per test and save the baselines.
+
+    The baseline of a test is the median wall time of its successful runs,
+    from which the timeout is derived by `TimeoutFactor` and `TimeoutFloor`.
+    The baselines of the other tests in `TimeoutFile` are kept.
+    """
+    if not judge.timeout_file:
+        judge.error_handler.handle(
+            "`TimeoutFile` field was not found in config file. "
+            + "Please check `judge.conf` first.",
+            exit_or_log="exit",
+        )
+    judge.build()
+    # Measure with `RunTimeout`, since the reference may be slower than it
+    # was at the previous calibration
+    judge.test_timeouts = {}
+    baselines = {}
+    for test in judge.tests:
+        wall_times = []
+        for _ in range(runs):
+            returncode, _, usage = judge.run(test.input_filepath)
+            if returncode == 0 and usage is not None:
+                wall_times.append(usage.wall_time)
+        if not wall_times:
+            judge.error_handler.handle(
+                f"Failed to calibrate `{test.test_name}`; the reference solution "
+                + "did not finish successfully."
+            )
+            continue
+        baselines[test.test_name] = median(wall_times)
+    judge.clean_scratch("local")
+    # Keep the baselines of the tests which are not calibrated this time
+    calibration.save(
+        judge.timeout_file,
+        {**calibration.load(judge.timeout_file), **baselines},
+        runs,
+    )
+    timeouts = calibration.timeouts(
+        baselines, judge.timeout_factor, judge.timeout_floor
+    )
+    print(f"{'test':<16} {'baseline':>10} {'timeout':>10}")
+    for name, baseline in baselines.items():
+        print(f"{name:<16} {baseline:>9.3f}s {timeouts[name]:>9.3f}s")
+
+
+def copy_output_to_dir(judge: LocalJudge, output_dir, ans_ext):
     """Copy output files into given directory without judgement.
 
     Usually used to create answer files or save the outputs for debugging.
@@ -328,13 +1224,12 @@ def copy_output_to_dir(judge: LocalJudge, output_dir, delete_temp_output, ans_ex
     judge.build()
 
     for test in judge.tests:
-        _, output_filepath = judge.run(test.input_filepath, with_timestamp=False)
+        _, output_filepath, _ = judge.run(test.input_filepath)
         copyfile(
             output_filepath,
             utils.expand_path(output_dir, utils.get_filename(output_filepath), ans_ext),
         )
-        if delete_temp_output == "true":
-            os.remove(output_filepath)
+    judge.clean_scratch("local")
 
 
 def main() -> int:
@@ -360,23 +1255,49 @@ def main() -> int:
     # Assign specific input for this judgement
     if not args.input is None:
         args.verbose = True
-        judge.tests = judge.inputs_to_tests(
-            utils.create_specific_input(args.input, config)
+        judge.set_tests(
+            judge.inputs_to_tests(utils.create_specific_input(args.input, config))
         )
+    if not args.shard is None:
+        judge.shard(*args.shard)
+
+    if not args.calibrate is None:
+        calibrate(judge, args.calibrate)
+        return 0
 
     # Copy output files into given directory without judgement
     if not args.output is None:
         copy_output_to_dir(
             judge,
             args.output,
-            config["Config"]["DeleteTempOutput"],
             config["Config"]["AnswerExtension"],
         )
 
     score_dict = json.loads(config["Config"]["ScoreDict"])
     # total_score will be used when the number of tests out of score_dict
     total_score = json.loads(config["Config"]["TotalScore"])
-    returncode = judge_all_tests(judge, args.verbose, score_dict, total_score)
+    max_failures = 1 if args.fail_fast else args.max_failures
+    # The history is only kept for the options which use it
+    history = None
+    if args.prioritize or max_failures is not None:
+        history = TestHistory(
+            config["Config"].get(
+                "TestHistoryFile", os.path.join(judge.temp_output_dir, "history.json")
+            )
+        )
+    if args.prioritize:
+        judge.prioritize(history.stats())
+    returncode = judge_all_tests(
+        judge,
+        args.verbose,
+        score_dict,
+        total_score,
+        args.test_jobs,
+        max_failures,
+        history,
+    )
+    judge.close()
+    print_compiler_cache_stats(judge)
     return returncode
 
 
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import pickle
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+from .sandbox import STOPPED_SHELL, Child, exit_code, peak_rss, prlimit, ptrace
+
+# The stderr kept for the verdict, where the rest is discarded
+MAX_STDERR = 64 * 1024
+# How often the launcher checks the output with `OutputLimit`, the memory with
+# `MemoryLimit`, and the killed child
+POLL_INTERVAL = 0.02
+# The signals changed by python or the launcher, which are reset in the child
+RESTORED_SIGNALS = (signal.SIGPIPE, signal.SIGXFSZ, signal.SIGINT, signal.SIGTERM)
+REDIRECT_FLAGS = {
+    "wb": os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+    "ab": os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+}
+
+
+class Launcher:
+    """A persistent process which starts the programs for the judge.
+
+    The judge is a large process, which a Python before 3.10 forks to start
+    each program, so that the fork costs more than a tiny test. The launcher
+    is a small process started once, and it starts each program with
+    `posix_spawn`, by way of `STOPPED_SHELL` only when the program is limited
+    or traced to read its peak memory. The program is waited by the launcher, which sends back its
+    status and resource usage.
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "local_judge.launcher"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def launch(self, request):
+        """Send the request to the launcher and wait for its response.
+
+        The request is a dict created by `make_request`. The response is a
+        dict of `returncode`, `err`, `verdict` (None, "TLE", "OLE", or "MLE"),
+        `wall_time`, `cpu_time`, and `max_rss`, or of `error` if the program
+        could not be started.
+        """
+        try:
+            pickle.dump(request, self.process.stdin)
+            self.process.stdin.flush()
+            return pickle.load(self.process.stdout)
+        except KeyboardInterrupt:
+            # The launcher kills the running program when it is terminated
+            self.process.terminate()
+            self.process.wait()
+            raise KeyboardInterrupt from None
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class LauncherPool:
+    """The launchers shared by all threads of the judge.
+
+    A launcher runs one program at a time, so each test takes an idle
+    launcher, or starts one if none is idle, and gives it back when it is
+    done. There are as many launchers as the tests which ever ran at once,
+    however many threads have come and gone, and `close` stops all of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._launchers = []
+        self._idle = []
+
+    def __getstate__(self):
+        # A launcher is never shared between processes
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def launch(self, request):
+        with self._lock:
+            launcher = self._idle.pop() if self._idle else None
+        if launcher is None or launcher.process.poll() is not None:
+            launcher = Launcher()
+            with self._lock:
+                self._launchers.append(launcher)
+        try:
+            return launcher.launch(request)
+        finally:
+            with self._lock:
+                self._idle.append(launcher)
+
+    def close(self):
+        with self._lock:
+            launchers = self._launchers
+            self._launchers = []
+            self._idle = []
+        for launcher in launchers:
+            launcher.close()
+
+
+def make_request(
+    argv,
+    cwd,
+    stdin=None,
+    stdout=None,
+    stdout_mode="wb",
+    timeout=None,
+    output_limit=None,
+    memory_limit=None,
+    limits=(),
+    trace=False,
+):
+    """Create the request to launch a program.
+
+    `limits` is a list of (resource, soft, hard) set in the child, and the
+    peak memory of the child is measured if `trace` is true.
+    """
+    return {
+        "argv": list(argv),
+        "cwd": os.path.abspath(cwd),
+        "stdin": stdin,
+        "stdout": stdout,
+        "stdout_mode": stdout_mode,
+        "timeout": timeout,
+        "output_limit": output_limit,
+        "memory_limit": memory_limit,
+        "limits": list(limits),
+        "trace": trace,
+    }
+
+
+def _open_fds(request):
+    stdin = request["stdin"] or os.devnull
+    stdout = request["stdout"] or os.devnull
+    return (
+        os.open(stdin, os.O_RDONLY),
+        os.open(stdout, REDIRECT_FLAGS[request["stdout_mode"]], 0o644),
+    )
+
+
+def _spawn(request, err_fd):
+    """Start the program in a new session and return its `Child`."""
+    argv = request["argv"]
+    stopped = bool(request["limits"]) or (request["trace"] and ptrace is not None)
+    if stopped:
+        if prlimit is None:
+            raise OSError("resource limits are not supported on " + sys.platform)
+        argv = list(STOPPED_SHELL) + argv
+    stdin_fd, stdout_fd = _open_fds(request)
+    try:
+        pid = os.posix_spawnp(
+            argv[0],
+            argv,
+            os.environ,
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, stdin_fd, 0),
+                (os.POSIX_SPAWN_DUP2, stdout_fd, 1),
+                (os.POSIX_SPAWN_DUP2, err_fd, 2),
+            ],
+            setsid=True,
+            setsigdef=RESTORED_SIGNALS,
+        )
+    finally:
+        os.close(stdin_fd)
+        os.close(stdout_fd)
+    child = Child(pid)
+    if stopped:
+        child.attach(request["limits"], request["trace"])
+    return child
+
+
+def _wait(child, timeout):
+    """Wait for the child to exit, and return whether it has exited."""
+    deadline = time.monotonic() + timeout
+    while not child.poll():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def _kill(child, grace_period=1.0):
+    """Same as `sandbox.kill_process_group` but for the child of the launcher."""
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(child.pid, signum)
+        except ProcessLookupError:
+            break
+        if _wait(child, grace_period):
+            return
+    while not _wait(child, grace_period):
+        pass
+
+
+def _over(max_rss, memory_limit):
+    return max_rss is not None and max_rss * 1024 > memory_limit
+
+
+def _output_size(request):
+    try:
+        return os.path.getsize(request["stdout"])
+    except (OSError, TypeError):
+        return 0
+
+
+# The program being waited, which is killed if the launcher is terminated
+_running_pid = None
+# The read end of the pipe which wakes up the launcher on SIGCHLD
+_wakeup_fd = None
+
+
+def _terminate(signum, frame):
+    if _running_pid is not None:
+        try:
+            os.killpg(_running_pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    sys.exit(1)
+
+
+def serve(request):
+    """Launch the program of the request and wait for it."""
+    try:
+        os.chdir(request["cwd"])
+        err_read, err_write = os.pipe()
+    except OSError as e:
+        return {"error": str(e)}
+    global _running_pid
+    start_time = time.monotonic()
+    try:
+        child = _spawn(request, err_write)
+    except OSError as e:
+        os.close(err_read)
+        return {"error": str(e)}
+    finally:
+        os.close(err_write)
+    _running_pid = child.pid
+    timeout = request["timeout"]
+    output_limit = request["output_limit"]
+    memory_limit = request["memory_limit"]
+    deadline = None if timeout is None else start_time + timeout
+    err = bytearray()
+    verdict = None
+    fds = [err_read, _wakeup_fd]
+    while not child.poll():
+        wait = None
+        if output_limit is not None or memory_limit is not None:
+            wait = POLL_INTERVAL
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+            wait = remaining if wait is None else min(wait, remaining)
+        ready, _, _ = select.select(fds, [], [], wait)
+        if err_read in ready:
+            data = os.read(err_read, 65536)
+            if data:
+                if len(err) < MAX_STDERR:
+                    err += data[: MAX_STDERR - len(err)]
+            else:
+                fds.remove(err_read)
+        if _wakeup_fd in ready:
+            # The child has exited or stopped
+            os.read(_wakeup_fd, 4096)
+        elif deadline is not None and time.monotonic() >= deadline:
+            verdict = "TLE"
+            _kill(child)
+        elif output_limit is not None and _output_size(request) > output_limit:
+            verdict = "OLE"
+            _kill(child, grace_period=0)
+        elif memory_limit is not None and _over(peak_rss(child.pid), memory_limit):
+            verdict = "MLE"
+            _kill(child, grace_period=0)
+    _running_pid = None
+    wall_time = time.monotonic() - start_time
+    # Drain the stderr left by the program, but not by its orphans
+    while err_read in fds and select.select([err_read], [], [], 0)[0]:
+        data = os.read(err_read, 65536)
+        if not data or len(err) >= MAX_STDERR:
+            break
+        err += data[: MAX_STDERR - len(err)]
+    os.close(err_read)
+    cpu_time, max_rss = child.usage()
+    return {
+        "returncode": exit_code(child.status),
+        "err": bytes(err),
+        "verdict": verdict,
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "max_rss": max_rss,
+    }
+
+
+def main():
+    # The protocol uses stdin and stdout, which are never given to the programs
+    requests = os.fdopen(os.dup(0), "rb")
+    responses = os.fdopen(os.dup(1), "wb")
+    null = os.open(os.devnull, os.O_RDWR)
+    os.dup2(null, 0)
+    os.dup2(null, 1)
+    # The launcher is stopped by the judge, not by Ctrl-C of the terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate)
+    # The exits and the stops of the programs are waited by select
+    global _wakeup_fd
+    _wakeup_fd, wakeup_write = os.pipe()
+    os.set_blocking(_wakeup_fd, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    while True:
+        try:
+            request = pickle.load(requests)
+        except EOFError:
+            return
+        pickle.dump(serve(request), responses)
+        responses.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import os
+
+from . import utils
+from .cache import hash_file
+from .sandbox import Usage
+
+
+class Manifest:
+    """The submissions and their last results, which are kept across runs.
+
+    Each student maps to the size, mtime, and hash of the archive together
+    with the result row and the usages of the last judgement. The results are
+    only valid for the same judging, so a manifest of another `key`, e.g. from
+    `LocalJudge.judging_key` of other tests, answers, or limits, is discarded.
+    """
+
+    def __init__(self, path, key, load=True):
+        self.path = path
+        self.key = key
+        self.students = {}
+        self._hashes = {}
+        if load and os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("key") == self.key:
+                self.students = data.get("students", {})
+
+    def fingerprint(self, student):
+        """Get the size, mtime, and hash of the archive of the student.
+
+        The archive is not read again if its size and mtime are unchanged.
+        """
+        if student.id in self._hashes:
+            return self._hashes[student.id]
+        stat = os.stat(student.zip_path)
+        old = self.students.get(student.id)
+        if (
+            old is not None
+            and old["zip_path"] == student.zip_path
+            and old["size"] == stat.st_size
+            and old["mtime"] == stat.st_mtime_ns
+        ):
+            digest = old["hash"]
+        else:
+            digest = hash_file(student.zip_path).hexdigest()
+        self._hashes[student.id] = digest
+        return digest
+
+    def changed(self, students):
+        """Filter out the students whose archives are the same as last time."""
+        changed = []
+        for student in students:
+            old = self.students.get(student.id)
+            if old is None or old["hash"] != self.fingerprint(student):
+                changed.append(student)
+        return changed
+
+    def update(self, student, result, usages):
+        digest = self.fingerprint(student)
+        stat = os.stat(student.zip_path)
+        self.students[student.id] = {
+            "zip_path": student.zip_path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": digest,
+            "result": result,
+            "usages": usages,
+        }
+
+    def forget(self, student_id):
+        self.students.pop(student_id, None)
+
+    def retain(self, students):
+        """Drop the students whose archives were removed."""
+        ids = {s.id for s in students}
+        self.students = {k: v for k, v in self.students.items() if k in ids}
+
+    def results(self):
+        return {k: v["result"] for k, v in self.students.items()}
+
+    def usages(self):
+        return {
+            k: [None if u is None else Usage(*u) for u in v["usages"]]
+            for k, v in self.students.items()
+            if v["usages"] is not None
+        }
+
+    def save(self):
+        utils.atomic_write_json(self.path, {"key": self.key, "students": self.students})
@@ -31,6 +31,14 @@ RED = "\033[31m"
 NC = "\033[0m"
 
 
+def format_seconds(seconds):
+    return "-" if seconds is None else "{:.3f}s".format(seconds)
+
+
+def format_kib(kib):
+    return "-" if kib is None else "{:.1f}MB".format(kib / 1024)
+
+
 class Report:
     def __init__(self, report_verbose=0, score_dict=None, total_score=0):
         self.score_dict = score_dict
@@ -69,12 +77,25 @@ class Report:
         dash = "".join(list(repeat("-", int(columns))))
         dash = dash[: test_len + 1] + "+" + dash[test_len + 2 :]
 
+        # Show the resource usage when it was measured (not from the cache)
+        show_usage = any(row.get("usage") is not None for row in self.table)
         print(doubledash)
-        print("{:>{width}} | {}".format("Sample", "Accept", width=test_len))
+        title = "{:>{width}} | {}".format("Sample", "Accept", width=test_len)
+        if show_usage:
+            title += " | {:>8} | {:>8} | {:>9}".format("Time", "CPU", "Memory")
+        print(title)
         for row in self.table:
             print(doubledash)
             mark = GREEN + "✔" + NC if row["accept"] else RED + "✘" + NC
-            print("{:>{width}} | {}".format(row["test"], mark, width=test_len))
+            line = "{:>{width}} | {}".format(row["test"], mark, width=test_len)
+            if show_usage:
+                usage = row.get("usage")
+                line += "      | {:>8} | {:>8} | {:>9}".format(
+                    format_seconds(usage.wall_time if usage else None),
+                    format_seconds(usage.cpu_time if usage else None),
+                    format_kib(usage.max_rss if usage else None),
+                )
+            print(line)
             if not row["accept"] and int(self.report_verbose) > 0:
                 print(dash)
                 print(row["diff"])
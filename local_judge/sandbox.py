@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import ctypes
+import os
+import resource
+import selectors
+import signal
+import sys
+import threading
+import time
+from collections import namedtuple
+from subprocess import Popen, TimeoutExpired
+
+# wall_time and cpu_time are in seconds, max_rss is in KiB
+Usage = namedtuple("Usage", ("wall_time", "cpu_time", "max_rss"))
+
+# The requests, options, and events of ptrace(2) used to read the peak memory
+PTRACE_CONT = 7
+PTRACE_SEIZE = 0x4206
+PTRACE_O_TRACEEXIT = 0x40
+PTRACE_O_EXITKILL = 0x100000
+PTRACE_EVENT_EXIT = 6
+# The address space is limited to this many times `MemoryLimit`, so that an
+# allocation far beyond the limit fails instead of swapping, while the peak
+# memory of a program which is over the limit is still measured
+ADDRESS_SPACE_FACTOR = 2
+# The shell which stops itself before it runs the program, so that the limits
+# of the program are set and it is traced before the program starts
+STOPPED_SHELL = ("/bin/sh", "-c", 'kill -STOP $$; exec "$@"', "sh")
+
+
+def _load_ptrace():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        ptrace = ctypes.CDLL(None, use_errno=True).ptrace
+    except (AttributeError, OSError):
+        return None
+    ptrace.restype = ctypes.c_long
+    ptrace.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_void_p, ctypes.c_void_p)
+    return ptrace
+
+
+ptrace = _load_ptrace()
+# Set the resource limits of another process, which is only on Linux
+prlimit = getattr(resource, "prlimit", None)
+
+
+def own_max_rss(max_rss):
+    """Keep the peak memory of a child only if it is not the one of the judge.
+
+    The memory of the process which spawns the child is counted in the peak
+    of the child from wait4, because the child is a copy of it before exec.
+    The peak is only known to be the child's own when it is larger than that
+    memory. It is only used when the child cannot be traced.
+    """
+    if max_rss is None:
+        return None
+    if max_rss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+    return max_rss
+
+
+def peak_rss(pid):
+    """Get the peak memory of a running process in KiB, or None if it has exited."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def exit_code(status):
+    # Same as os.waitstatus_to_exitcode, which needs Python 3.9
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Child:
+    """A child process which is reaped by `poll`.
+
+    A child started by `STOPPED_SHELL` is set up by `attach` before it runs
+    the program. If it is traced, it is stopped when it exits, before its
+    memory is released, so that the peak memory of the program alone is read
+    from /proc. The peak from wait4 also counts the memory of the process
+    which spawned it.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.status = None
+        self.rusage = None
+        self.peak_rss = None
+
+    def attach(self, limits=(), trace=False):
+        """Set the limits of the stopped shell, trace it, and let it run.
+
+        `limits` is a list of (resource, soft, hard). The stops of a traced
+        child are only resumed by its tracer, so the thread which attaches
+        the child has to poll it as well.
+        """
+        _, status, rusage = os.wait4(self.pid, os.WUNTRACED)
+        if not os.WIFSTOPPED(status):
+            # Killed before it stopped
+            self.status, self.rusage = status, rusage
+            return
+        if trace and ptrace is not None:
+            # The child is not traced if it is not allowed, and its peak from
+            # wait4 is used as long as it cannot be the one of the judge
+            ptrace(PTRACE_SEIZE, self.pid, None, PTRACE_O_TRACEEXIT | PTRACE_O_EXITKILL)
+        try:
+            for which, soft, hard in limits:
+                prlimit(self.pid, which, (soft, hard))
+        except OSError:
+            os.kill(self.pid, signal.SIGKILL)
+            self.poll(block=True)
+            raise
+        os.kill(self.pid, signal.SIGCONT)
+
+    def poll(self, block=False):
+        """Check whether the child has exited, where it is reaped.
+
+        The stops of a traced child, e.g. for a signal, are resumed here.
+        """
+        while self.status is None:
+            pid, status, rusage = os.wait4(self.pid, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return False
+            if not os.WIFSTOPPED(status):
+                self.status, self.rusage = status, rusage
+                break
+            event = status >> 16
+            if event == PTRACE_EVENT_EXIT:
+                self.peak_rss = peak_rss(self.pid)
+            # Deliver the signal which stopped it, but not the trap of an event
+            ptrace(PTRACE_CONT, self.pid, None, 0 if event else os.WSTOPSIG(status))
+        return True
+
+    def usage(self):
+        """Get the cpu time and the peak memory of the reaped child."""
+        if self.rusage is None:
+            return None, None
+        max_rss = self.peak_rss
+        if max_rss is None:
+            max_rss = own_max_rss(self.rusage.ru_maxrss)
+        return self.rusage.ru_utime + self.rusage.ru_stime, max_rss
+
+
+class Process:
+    """A program run by the judge, which is reaped by a thread of its own.
+
+    It is used like `Popen`, and its resource usage is kept when it exits.
+    With `limits` or `trace`, the program is started by `STOPPED_SHELL`, and
+    the thread sets its limits and traces it before the program starts, so
+    no `preexec_fn` runs in the child while other threads of the judge hold
+    locks. Popen only starts the child; the thread is its only waiter.
+    """
+
+    def __init__(
+        self, args, shell=False, executable=None, limits=(), trace=False, **kwargs
+    ):
+        if shell:
+            args = [executable or "/bin/sh", "-c", args]
+        self.args = list(args)
+        stopped = bool(limits) or (trace and ptrace is not None)
+        if stopped and prlimit is None:
+            raise OSError("resource limits are not supported on " + sys.platform)
+        self._popen = Popen(
+            list(STOPPED_SHELL) + self.args if stopped else self.args, **kwargs
+        )
+        self.pid = self._popen.pid
+        self.stdout = self._popen.stdout
+        self.stderr = self._popen.stderr
+        self.returncode = None
+        self._child = Child(self.pid)
+        self._error = None
+        self._output = {}
+        self._exited = threading.Event()
+        threading.Thread(
+            target=self._reap, args=(stopped, limits, trace), daemon=True
+        ).start()
+
+    def _reap(self, stopped, limits, trace):
+        try:
+            if stopped:
+                self._child.attach(limits, trace)
+        except OSError as e:
+            self._error = e
+        self._child.poll(block=True)
+        self.returncode = exit_code(self._child.status)
+        # Popen never waits for the child, which is reaped here
+        self._popen.returncode = self.returncode
+        self._exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise TimeoutExpired(self.args, timeout)
+        if self._error is not None:
+            raise self._error
+        return self.returncode
+
+    def communicate(self, timeout=None):
+        """Same as `Popen.communicate` without input.
+
+        It can be retried after `TimeoutExpired` without losing the output
+        read so far.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            for pipe in (self.stdout, self.stderr):
+                if pipe is not None and not pipe.closed:
+                    selector.register(pipe, selectors.EVENT_READ)
+                    self._output.setdefault(pipe, bytearray())
+            while selector.get_map():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutExpired(self.args, timeout)
+                for key, _ in selector.select(remaining):
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        self._output[key.fileobj] += data
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+        self.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return tuple(
+            None if pipe is None else bytes(self._output[pipe])
+            for pipe in (self.stdout, self.stderr)
+        )
+
+    def peak_rss(self):
+        """Get the peak memory of the running program in KiB."""
+        return peak_rss(self.pid)
+
+    def usage(self, wall_time):
+        cpu_time, max_rss = self._child.usage()
+        return Usage(wall_time, cpu_time, max_rss)
+
+
+def resource_limits(
+    memory_limit=None, cpu_time_limit=None, process_limit=None, file_size_limit=None
+):
+    """Get the list of (resource, soft, hard) to set in the child.
+
+    The address space is limited to `ADDRESS_SPACE_FACTOR` times the memory
+    limit, and the file size limit is applied to every file written by the
+    child.
+    """
+    limits = []
+    if memory_limit is not None:
+        address_space = ADDRESS_SPACE_FACTOR * memory_limit
+        limits.append((resource.RLIMIT_AS, address_space, address_space))
+    if cpu_time_limit is not None:
+        # SIGXCPU at the soft limit and SIGKILL one second later
+        cpu_time_limit = int(-(-float(cpu_time_limit) // 1))
+        limits.append((resource.RLIMIT_CPU, cpu_time_limit, cpu_time_limit + 1))
+    if process_limit is not None:
+        limits.append((resource.RLIMIT_NPROC, process_limit, process_limit))
+    if file_size_limit is not None:
+        limits.append((resource.RLIMIT_FSIZE, file_size_limit, file_size_limit))
+    return limits
+
+
+def kill_process_group(process, grace_period=1.0):
+    """Terminate the process group of the process and reap the process.
+
+    The rest of the group is killed after the grace period, so that neither
+    the process nor its children can survive by ignoring SIGTERM.
+    """
+    try:
+        pgid = os.getpgid(process.pid)
+    except ProcessLookupError:
+        process.wait()
+        return
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            # Ref: https://stackoverflow.com/a/44705997
+            os.killpg(pgid, signum)
+        except ProcessLookupError:
+            break
+        try:
+            process.wait(timeout=grace_period)
+        except TimeoutExpired:
+            pass
+    process.wait()
+
+
+def killed_by(returncode, signum):
+    """Check whether the process or the bash running it was killed by the signal."""
+    return returncode in (-signum, 128 + signum)
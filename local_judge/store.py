@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from .sandbox import Usage
+
+# The diffs are truncated to keep the database small
+DIFF_LIMIT = 4096
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, started_at REAL NOT NULL, "
+    "mode TEXT NOT NULL, tests TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS students ("
+    "run_id INTEGER NOT NULL, student_id TEXT NOT NULL, "
+    "in_log INTEGER NOT NULL, log_msg TEXT, error TEXT NOT NULL, "
+    "PRIMARY KEY (run_id, student_id))",
+    "CREATE TABLE IF NOT EXISTS verdicts ("
+    "run_id INTEGER NOT NULL, student_id TEXT NOT NULL, "
+    "test_index INTEGER NOT NULL, test_name TEXT NOT NULL, "
+    "accepted INTEGER NOT NULL, wall_time REAL, cpu_time REAL, max_rss INTEGER, "
+    "diff TEXT NOT NULL, PRIMARY KEY (run_id, student_id, test_index))",
+    "CREATE INDEX IF NOT EXISTS students_latest ON students (student_id, run_id)",
+    "CREATE INDEX IF NOT EXISTS verdicts_history "
+    "ON verdicts (student_id, test_name, run_id)",
+    "CREATE INDEX IF NOT EXISTS verdicts_test ON verdicts (test_name, accepted)",
+)
+
+# The last run of each student among the runs of the same tests
+LATEST = (
+    "WITH latest AS (SELECT student_id, MAX(run_id) AS run_id FROM students "
+    "WHERE run_id IN (SELECT id FROM runs WHERE tests = ?) GROUP BY student_id) "
+)
+
+
+class ResultStore:
+    """The verdicts of all runs stored in a SQLite database.
+
+    Each run keeps the row of each judged student and the verdict, usage and
+    truncated diff of each test, so the score table can be made again and
+    the runs can be compared without judging. Only the main process writes
+    the database.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def start_run(self, test_names, mode):
+        """Add a run of the tests and return its id."""
+        with closing(self._connect()) as conn, conn:
+            return conn.execute(
+                "INSERT INTO runs (started_at, mode, tests) VALUES (?, ?, ?)",
+                (time.time(), mode, json.dumps(list(test_names))),
+            ).lastrowid
+
+    def add_students(self, run_id, test_names, students):
+        """Add the students of the run in one transaction.
+
+        Each student is `(student_id, result, usages, diffs, error)`, where
+        `result` is the row of the score table.
+        """
+        with closing(self._connect()) as conn, conn:
+            for student_id, result, usages, diffs, error in students:
+                log = result[len(test_names) :]
+                conn.execute(
+                    "INSERT OR REPLACE INTO students VALUES (?, ?, ?, ?, ?)",
+                    (run_id, student_id, log[0], (log[1:] or [None])[0], error),
+                )
+                usages = usages or [None] * len(test_names)
+                diffs = diffs or [""] * len(test_names)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO verdicts VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        (run_id, student_id, i, test_name, int(result[i] or 0))
+                        + (tuple(usages[i]) if usages[i] is not None else (None,) * 3)
+                        + ((diffs[i] or "")[:DIFF_LIMIT],)
+                        for i, test_name in enumerate(test_names)
+                    ),
+                )
+
+    def _results(self, conn, join, params, prefix=""):
+        results = {}
+        for student_id, in_log, log_msg in conn.execute(
+            prefix + "SELECT s.student_id, s.in_log, s.log_msg FROM students s " + join,
+            params,
+        ):
+            results[student_id] = [in_log] if log_msg is None else [in_log, log_msg]
+        correctness = {}
+        usages = {}
+        for student_id, accepted, wall_time, cpu_time, max_rss in conn.execute(
+            prefix
+            + "SELECT v.student_id, v.accepted, v.wall_time, v.cpu_time, v.max_rss "
+            + "FROM verdicts v "
+            + join
+            + " ORDER BY v.test_index",
+            params,
+        ):
+            correctness.setdefault(student_id, []).append(accepted)
+            usages.setdefault(student_id, []).append(
+                None if wall_time is None else Usage(wall_time, cpu_time, max_rss)
+            )
+        results = {k: correctness.get(k, []) + v for k, v in results.items()}
+        return results, usages
+
+    def run_results(self, run_id):
+        """Return the results and the usages of the students of the run."""
+        with closing(self._connect()) as conn:
+            return self._results(conn, "WHERE run_id = ?", (run_id,))
+
+    def latest_results(self, test_names):
+        """Return the results and the usages of the last run of each student."""
+        with closing(self._connect()) as conn:
+            return self._results(
+                conn,
+                "JOIN latest USING (student_id, run_id)",
+                (json.dumps(list(test_names)),),
+                LATEST,
+            )
+
+    def test_stats(self, test_names, skipped_diff):
+        """Return the failure rate and the mean wall time of each test.
+
+        Only the last run of each student is counted, where the skipped
+        tests (of `skipped_diff`) are left out.
+        """
+        with closing(self._connect()) as conn:
+            return {
+                test_name: (failure_rate, mean_time)
+                for test_name, failure_rate, mean_time in conn.execute(
+                    LATEST
+                    + "SELECT v.test_name, AVG(1 - v.accepted), AVG(v.wall_time) "
+                    + "FROM verdicts v JOIN latest USING (student_id, run_id) "
+                    + "WHERE v.diff != ? GROUP BY v.test_name",
+                    (json.dumps(list(test_names)), skipped_diff),
+                )
+            }
+
+    def last_run(self):
+        """Return the id of the last run, or None if there is no run."""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT MAX(id) FROM runs").fetchone()[0]
+
+    def failures(self, test_names):
+        """Count the rejected tests over the last run of each student.
+
+        Return `(test_name, rejected, total)` from the most rejected test.
+        """
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                LATEST
+                + "SELECT v.test_name, SUM(1 - v.accepted), COUNT(*) FROM verdicts v "
+                + "JOIN latest USING (student_id, run_id) "
+                + "GROUP BY v.test_name ORDER BY 2 DESC, MIN(v.test_index)",
+                (json.dumps(list(test_names)),),
+            ).fetchall()
+
+    def changes(self, run_id):
+        """Return the verdicts of the run which differ from the previous ones.
+
+        Each change is `(student_id, test_name, accepted)`, compared with the
+        last earlier run of the same student and test.
+        """
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT v.student_id, v.test_name, v.accepted FROM verdicts v "
+                + "JOIN verdicts p ON p.student_id = v.student_id "
+                + "AND p.test_name = v.test_name AND p.run_id = ("
+                + "SELECT MAX(run_id) FROM verdicts WHERE student_id = v.student_id "
+                + "AND test_name = v.test_name AND run_id < v.run_id) "
+                + "WHERE v.run_id = ? AND p.accepted != v.accepted "
+                + "ORDER BY v.student_id, v.test_index",
+                (run_id,),
+            ).fetchall()
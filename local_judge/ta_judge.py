@@ -38,21 +38,35 @@ import argparse
 import configparser
 import os
 import errno
-from openpyxl import load_workbook
-from zipfile import ZipFile
-import rarfile
-import tarfile
 from glob import glob as globbing
 import re
 from collections import namedtuple
 import logging
 import multiprocessing
+import queue
 import signal
+import json
+import asyncio
 import time
 
-from .judge import LocalJudge
+from . import archive
+from . import export
+from . import index
+from . import trace
+from . import workspace
+from .async_judge import AsyncJudge, to_thread
+from .judge import (
+    RUN_VERDICTS,
+    SKIPPED_VERDICT,
+    TLE_RETURNCODE,
+    LocalJudge,
+    print_compiler_cache_stats,
+)
+from .manifest import Manifest
+from .store import ResultStore
 from .error_handler import ErrorHandler
 from .report import Report
+from .utils import parse_size
 
 Student = namedtuple("Student", ("id", "zip_type", "zip_path", "extract_path"))
 
@@ -67,6 +81,13 @@ class TaJudge:
             self.update_student_pattern = self._config["UpdateStudentPattern"]
             self.students_extract_dir = self._config["StudentsExtractDir"]
             self.extract_afresh = self._config["ExtractAfresh"]
+            self.extract_max_size = parse_size(self._config.get("ExtractMaxSize", "1G"))
+            self.extract_max_files = int(self._config.get("ExtractMaxFiles", "10000"))
+            self.workspace_mode = self._config.get("WorkspaceMode", "extract")
+            # The files written by the build, which `hardlink` must not share
+            self.workspace_private = self._config.get(
+                "WorkspacePrivateFiles", ""
+            ).split()
         except KeyError as e:
             self.error_handler.handle(
                 str(e)
@@ -84,6 +105,17 @@ class TaJudge:
                     str(e),
                     exit_or_log="exit",
                 )
+        if self.workspace_mode not in workspace.MODES:
+            self.error_handler.handle(
+                "Unknown `WorkspaceMode = "
+                + self.workspace_mode
+                + "`. Available: "
+                + ", ".join(workspace.MODES)
+                + ". Please check `ta_judge.conf` first.",
+                exit_or_log="exit",
+            )
+        # The read-only extracted archives, from which the workspaces are made
+        self.pristine_dir = os.path.join(self.students_extract_dir, ".pristine")
         self.students_zips = globbing(self.students_zip_container + os.sep + "*")
         # Parse the students' id and sort them
         self.students = self._parse_students()
@@ -127,25 +159,52 @@ class TaJudge:
 
     def extract_student(self, student):
         """Used to extract students' zip file."""
+        with trace.span("extract", student_id=student.id):
+            self._extract_student(student)
+
+    def _extract_student(self, student):
+        if self.workspace_mode == "extract":
+            self._extract(student, self.students_extract_dir)
+            return
+        self._extract(student, self.pristine_dir, read_only=True)
+        pristine_path = self.pristine_path(student)
+        if os.path.isdir(pristine_path):
+            workspace.populate(
+                pristine_path,
+                student.extract_path,
+                self.workspace_mode,
+                self.workspace_private,
+            )
+
+    def pristine_path(self, student):
+        """Get the path of the student in the pristine tree."""
+        return os.path.join(
+            self.pristine_dir,
+            os.path.relpath(
+                student.extract_path, os.path.abspath(self.students_extract_dir)
+            ),
+        )
+
+    def _extract(self, student, extract_dir, read_only=False):
         if self.extract_afresh == "false":
             return
+        if not archive.is_supported(student.zip_type):
+            logging.error(
+                str(student.id)
+                + " failed in extract stage with unknown zip type: `"
+                + student.zip_type
+                + "`"
+            )
+            return
         try:
-            if student.zip_type == "zip":
-                z = ZipFile(student.zip_path, "r")
-            elif student.zip_type == "tar":
-                z = tarfile.open(student.zip_path, "r")
-            elif student.zip_type == "rar":
-                z = rarfile.RarFile(student.zip_path)
-            else:
-                logging.error(
-                    str(student.id)
-                    + " failed in extract stage with unknown zip type: `"
-                    + student.zip_type
-                    + "`"
-                )
-                return
-            z.extractall(self.students_extract_dir)
-            z.close()
+            archive.extract(
+                student.zip_type,
+                student.zip_path,
+                extract_dir,
+                self.extract_max_size,
+                self.extract_max_files,
+                read_only,
+            )
         except Exception as e:
             logging.error(
                 "`" + str(student.id) + "` failed in extract stage. " + str(e)
@@ -171,13 +230,28 @@ def append_log_msg(ori_result, log_msg, in_log=1):
 
 
 def judge_one_student(
-    student, all_student_results, tj: TaJudge, lj: LocalJudge, skip_report=False
+    student,
+    all_student_results,
+    tj: TaJudge,
+    lj: LocalJudge,
+    skip_report=False,
+    test_jobs=1,
+    render_diff=None,
+    max_failures=None,
 ):
-    """Judge one student and return the correctness result."""
+    """Judge one student and return the correctness result.
+
+    The diffs are rendered unless the report is skipped or `render_diff` is
+    False. The tests after `max_failures` rejected ones are skipped.
+    """
+    if render_diff is None:
+        render_diff = not skip_report
     lj.error_handler.init_student(student.id)
     print(student.id)
     student_path = student.extract_path + os.sep
     correctness = [0] * len(lj.tests)
+    usages = [None] * len(lj.tests)
+    diffs = [""] * len(lj.tests)
     correct_cnt = 0
     report_table = []
     tj.extract_student(student)
@@ -188,26 +262,24 @@ def judge_one_student(
         )
     else:
         lj.build(student_id=student.id, cwd=student_path)
-        for i in range(len(lj.tests)):
-            returncode, output = lj.run(
-                lj.tests[i].input_filepath, student_id=student.id, cwd=student_path
-            )
-            accept, diff = lj.compare(
-                output,
-                lj.tests[i].answer_filepath,
-                returncode,
-                student_id=student.id,
-                cwd=student_path,
-            )
+        rows = lj.judge_tests(
+            student_id=student.id,
+            cwd=student_path,
+            jobs=test_jobs,
+            render_diff=render_diff,
+            max_failures=max_failures,
+        )
+        for i, row in enumerate(rows):
             if not skip_report:
-                report_table.append(
-                    {"test": lj.tests[i].test_name, "accept": accept, "diff": diff}
-                )
-            if accept:
+                report_table.append(row)
+            usages[i] = row.get("usage")
+            diffs[i] = row["diff"]
+            if row["accept"]:
                 correct_cnt += 1
                 correctness[i] = 1
             else:
                 correctness[i] = 0
+        lj.clean_scratch(student.id)
     # Not calcute the total score because there may be some hidden test cases
     # Use the formula of google sheet or excel to get the total score.
     result = append_log_msg(correctness, lj.error_handler.get_error(student.id))
@@ -217,38 +289,562 @@ def judge_one_student(
         "student_id": student.id,
         "result": result,
         "report_table": report_table,
+        "usages": usages,
+        "diffs": diffs,
     }
 
 
-def write_to_sheet(score_output_path, student_list_path, all_student_results, tests):
-    # Judge all students
-    # Init the table with the title
-    book = load_workbook(student_list_path)
-    sheet = book.active
+# The time a task may take beyond the timeouts of its subprocesses, after
+# which its worker is taken as hung or dead
+TASK_GRACE = 30
+# How often the parent checks the deadlines of the running tasks
+TASK_POLL_INTERVAL = 0.5
+
+# The judges of a pool worker, which are set once by `init_worker`
+_worker_tj = None
+_worker_lj = None
+# The queue of the started tasks, which is read by the parent
+_worker_started = None
+# The rejected tests of each student shared by all workers, and the limit
+_worker_failures = None
+_worker_max_failures = None
+
+
+def init_worker(
+    tj: TaJudge,
+    lj: LocalJudge,
+    started,
+    failures=None,
+    max_failures=None,
+    trace_path=None,
+):
+    """Initialize a pool worker with the judges shared by all its tasks.
+
+    The spans are traced into `trace_path`, since a worker which is spawned
+    instead of forked does not inherit the tracer of the parent.
+    """
+    global _worker_tj, _worker_lj, _worker_started
+    global _worker_failures, _worker_max_failures
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if trace_path is not None:
+        trace.enable(trace_path, truncate=False)
+    _worker_tj = tj
+    _worker_lj = lj
+    _worker_started = started
+    _worker_failures = failures
+    _worker_max_failures = max_failures
+
+
+def run_task(item):
+    """Tell the parent which worker starts the task, and run it."""
+    key, task, arg = item
+    _worker_started.put((key, os.getpid()))
+    return task(arg)
+
+
+class TaskResult:
+    """The compact result of one task sent back from a pool worker.
+
+    `index` is the index of the test, or 0 (-1 if the tests cannot be run)
+    for the build, and `accepted` tells whether the test is accepted.
+    """
+
+    __slots__ = (
+        "student_id",
+        "index",
+        "accepted",
+        "usage",
+        "error",
+        "executable_hash",
+        "diff",
+    )
+
+    def __init__(
+        self,
+        student_id,
+        index,
+        accepted,
+        usage,
+        error,
+        executable_hash=None,
+        diff="",
+    ):
+        self.student_id = student_id
+        self.index = index
+        self.accepted = accepted
+        self.usage = usage
+        self.error = error
+        self.executable_hash = executable_hash
+        self.diff = diff
+
+
+def extract_student_task(student):
+    """The extract stage of one student, which runs in a pool worker."""
+    _worker_tj.extract_student(student)
+    return student
+
+
+def build_student_task(student):
+    """The build stage of one student, which runs in a pool worker.
+
+    The index of the result is -1 if the tests cannot be run, otherwise 0.
+    """
+    lj = _worker_lj
+    lj.error_handler.init_student(student.id)
+    print(student.id)
+    student_path = student.extract_path + os.sep
+    if not os.path.isdir(student_path):
+        lj.error_handler.handle(
+            f"File architecture error: {str(student.id)}: {str(student_path)} not found",
+            student_id=student.id,
+        )
+        return TaskResult(
+            student.id, -1, False, None, lj.error_handler.get_error(student.id)
+        )
+    lj.build(student_id=student.id, cwd=student_path)
+    return TaskResult(
+        student.id,
+        0,
+        False,
+        None,
+        lj.error_handler.get_error(student.id),
+        lj.executable_hash(student_path),
+    )
+
+
+def judge_test_task(task):
+    """The stage of one test of one student, which runs in a pool worker.
+
+    Every subprocess of the stage is bounded by `Timeout` and its process
+    group is killed on timeout, so a hung test cannot hold the worker. The
+    test is skipped if the student has too many rejected tests. The outputs
+    are written into the scratch directory made by the parent for this run.
+    """
+    (
+        student_id,
+        extract_path,
+        index,
+        executable_hash,
+        render_diff,
+        position,
+        scratch_path,
+    ) = task
+    lj = _worker_lj
+    lj.error_handler.init_student(student_id)
+    lj._scratch_paths[student_id] = scratch_path
+    failures = _worker_failures
+    if failures is not None:
+        with failures.get_lock():
+            if failures[position] >= _worker_max_failures:
+                return TaskResult(
+                    student_id, index, False, None, "", diff=SKIPPED_VERDICT
+                )
+    row = lj.judge_test(
+        lj.tests[index],
+        student_id=student_id,
+        cwd=extract_path + os.sep,
+        render_diff=render_diff,
+        executable_hash=executable_hash,
+    )
+    if failures is not None and not row["accept"]:
+        with failures.get_lock():
+            failures[position] += 1
+    return TaskResult(
+        student_id,
+        index,
+        row["accept"],
+        row.get("usage"),
+        lj.error_handler.get_error(student_id),
+        diff=row["diff"],
+    )
+
+
+def judge_students_parallel(
+    students,
+    tj: TaJudge,
+    lj: LocalJudge,
+    jobs,
+    extract_jobs=None,
+    render_diff=False,
+    max_failures=None,
+):
+    """Judge the students on a pool by splitting the work into tasks.
+
+    The archives are extracted on a separate pool. Each extracted student
+    is submitted to the build of the judging pool, and the tests of each
+    built student are submitted as soon as its build completes, without
+    waiting for the other students. Each task is handed to the next free
+    worker and its result is processed as soon as it completes, whatever
+    the order. The judges are sent to each worker once, and a task only
+    carries the student and the test. With `max_failures` given, the
+    rejected tests of each student are counted in a shared array, and the
+    tests which start after `max_failures` are skipped. A started task which
+    outlives the timeouts of its stage by `TASK_GRACE`, e.g. a hung
+    extraction or a task of a dead worker, gets a TLE, and its worker is
+    killed and replaced by the pool. Return the results, the usages, and the
+    diffs of all students.
+    """
+    test_count = len(lj.tests)
+    accepted = {s.id: [0] * test_count for s in students}
+    usages = {s.id: [None] * test_count for s in students}
+    diffs = {s.id: [""] * test_count for s in students}
+    # The errors of each student are kept in the order of the stages
+    errors = {s.id: [""] * (test_count + 1) for s in students}
+    # The scratch directory of a student is removed after its last test
+    remaining = dict.fromkeys((s.id for s in students), len(lj.test_order))
+    extract_paths = {s.id: s.extract_path for s in students}
+    positions = {s.id: i for i, s in enumerate(students)}
+    failures = None
+    if max_failures is not None:
+        failures = multiprocessing.Array("i", len(students))
+    started = multiprocessing.Queue()
+    trace_path = trace.get_path()
+    extract_pool = multiprocessing.Pool(
+        extract_jobs or jobs, init_worker, (tj, lj, started, None, None, trace_path)
+    )
+    pool = multiprocessing.Pool(
+        jobs, init_worker, (tj, lj, started, failures, max_failures, trace_path)
+    )
+    # The results of all stages are sent back here by the callbacks of the pools
+    events = queue.Queue()
+    # The (stage, student_id, index, time budget) of each submitted task
+    tasks = []
+    pending = set()
+    # The worker and the deadline of each started task
+    running = {}
+    # The tasks lost with their killed workers, which the pools still wait for
+    expired_tasks = []
+
+    def submit(p, stage, task, arg, student_id, index, budget):
+        key = len(tasks)
+        tasks.append((stage, student_id, index, budget + TASK_GRACE))
+        pending.add(key)
+        p.apply_async(
+            run_task,
+            ((key, task, arg),),
+            callback=lambda res: events.put((key, res)),
+            error_callback=lambda e: events.put((key, e)),
+        )
+
+    def finish_test(student_id):
+        remaining[student_id] -= 1
+        if remaining[student_id] == 0:
+            lj.clean_scratch(student_id)
+
+    def expire(key):
+        stage, student_id, index, budget = tasks[key]
+        pid, _ = running.pop(key)
+        pending.discard(key)
+        expired_tasks.append(key)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        name = f"test {lj.tests[index].test_name}" if stage == "test" else stage
+        msg = f"TLE at {name} stage; kill the worker after {budget:g} seconds"
+        logging.error(student_id + " " + msg)
+        if stage == "test":
+            errors[student_id][index + 1] = msg + "\n"
+            diffs[student_id][index] = RUN_VERDICTS[TLE_RETURNCODE]
+            finish_test(student_id)
+        else:
+            errors[student_id][0] = msg + "\n"
+            lj.clean_scratch(student_id)
+
+    try:
+        for student in students:
+            # The extraction has no timeout of its own, so `Timeout` is used
+            budget = float(lj.timeout)
+            submit(
+                extract_pool,
+                "extract",
+                extract_student_task,
+                student,
+                student.id,
+                0,
+                budget,
+            )
+        while pending:
+            try:
+                key, res = events.get(timeout=TASK_POLL_INTERVAL)
+            except queue.Empty:
+                key = None
+            now = time.monotonic()
+            while True:
+                try:
+                    started_key, pid = started.get_nowait()
+                except queue.Empty:
+                    break
+                if started_key in pending:
+                    running[started_key] = (pid, now + tasks[started_key][3])
+            for expired in [k for k, (_, d) in running.items() if d <= now]:
+                expire(expired)
+            # Skip the late result of an expired task as well
+            if key not in pending:
+                continue
+            pending.discard(key)
+            running.pop(key, None)
+            if isinstance(res, BaseException):
+                raise res
+            stage = tasks[key][0]
+            if stage == "extract":
+                budget = lj.build_timeout
+                submit(pool, "build", build_student_task, res, res.id, 0, budget)
+            elif stage == "build":
+                errors[res.student_id][0] = res.error
+                if res.index < 0 or not lj.test_order:
+                    lj.clean_scratch(res.student_id)
+                    continue
+                scratch_path = lj.scratch_path(res.student_id)
+                for i in lj.test_order:
+                    task = (
+                        res.student_id,
+                        extract_paths[res.student_id],
+                        i,
+                        res.executable_hash,
+                        render_diff,
+                        positions[res.student_id],
+                        scratch_path,
+                    )
+                    # The runs of the test and the comparison of its output
+                    budget = lj.repeat * lj.test_timeout(lj.tests[i].input_filepath)
+                    budget += float(lj.timeout)
+                    submit(
+                        pool, "test", judge_test_task, task, res.student_id, i, budget
+                    )
+            else:
+                accepted[res.student_id][res.index] = int(res.accepted)
+                errors[res.student_id][res.index + 1] = res.error
+                usages[res.student_id][res.index] = res.usage
+                diffs[res.student_id][res.index] = res.diff
+                finish_test(res.student_id)
+    except KeyboardInterrupt:
+        for p in (extract_pool, pool):
+            p.terminate()
+            p.join()
+        raise KeyboardInterrupt from None
+    for p in (extract_pool, pool):
+        if expired_tasks:
+            p.terminate()
+        else:
+            p.close()
+        p.join()
+
+    all_student_results = {}
+    for s in students:
+        lj.error_handler.append(s.id, "".join(errors[s.id]))
+        all_student_results[s.id] = append_log_msg(
+            accepted[s.id], lj.error_handler.get_error(s.id)
+        )
+    return all_student_results, usages, diffs
+
+
+def judge_students_asyncio(
+    students, tj: TaJudge, lj: LocalJudge, jobs, render_diff=False, max_failures=None
+):
+    """Judge the students on the event loop of this process.
+
+    All the students are judged at the same time, and at most `jobs`
+    subprocesses are running at once. Return the results, the usages, and the
+    diffs of all students.
+    """
+    async_judge = AsyncJudge(lj, jobs)
+    test_count = len(lj.tests)
+
+    async def judge_student(student):
+        trace.new_task()
+        lj.error_handler.init_student(student.id)
+        print(student.id)
+        student_path = student.extract_path + os.sep
+        await to_thread(tj.extract_student, student)
+        if not os.path.isdir(student_path):
+            lj.error_handler.handle(
+                f"File architecture error: {str(student.id)}: {str(student_path)} not found",
+                student_id=student.id,
+            )
+            return None
+        await async_judge.build(student_id=student.id, cwd=student_path)
+        rows = await async_judge.judge_tests(
+            student_id=student.id,
+            cwd=student_path,
+            render_diff=render_diff,
+            max_failures=max_failures,
+        )
+        await to_thread(lj.clean_scratch, student.id)
+        return rows
+
+    async def judge_all():
+        return await asyncio.gather(*(judge_student(s) for s in students))
+
+    all_student_results = {}
+    all_student_usages = {}
+    all_student_diffs = {}
+    for student, rows in zip(students, asyncio.run(judge_all())):
+        if rows is None:
+            correctness = [0] * test_count
+            all_student_usages[student.id] = [None] * test_count
+            all_student_diffs[student.id] = [""] * test_count
+        else:
+            correctness = [1 if row["accept"] else 0 for row in rows]
+            all_student_usages[student.id] = [row["usage"] for row in rows]
+            all_student_diffs[student.id] = [row["diff"] for row in rows]
+        all_student_results[student.id] = append_log_msg(
+            correctness, lj.error_handler.get_error(student.id)
+        )
+    return all_student_results, all_student_usages, all_student_diffs
+
+
+def write_to_sheet(
+    score_output_path,
+    student_list_path,
+    all_student_results,
+    tests,
+    all_student_usages=None,
+    export_paths=(),
+):
+    """Write the results into the student list and save it as the score output.
+
+    If the usages are given, they are written into the second worksheet with
+    the wall time, CPU time, and peak memory of each test. The score table is
+    also exported to each of `export_paths` (`.csv` or `.jsonl`).
+    """
+    with trace.span("write_to_sheet"):
+        _write_to_sheet(
+            score_output_path,
+            student_list_path,
+            all_student_results,
+            tests,
+            all_student_usages,
+            export_paths,
+        )
+
+
+def _write_to_sheet(
+    score_output_path,
+    student_list_path,
+    all_student_results,
+    tests,
+    all_student_usages,
+    export_paths,
+):
+    # The student list is read in read-only mode and the score output is
+    # streamed by a write-only workbook, so no cell objects are kept
+    sheets = export.read_sheets(student_list_path)
+    title, student_rows = sheets[0]
+    rows = list(score_rows(student_rows, all_student_results, tests))
+    sheets[0] = (title, rows)
+    if all_student_usages is not None:
+        sheets.append(
+            ("performance", usage_rows(student_rows, all_student_usages, tests))
+        )
+    export.write_xlsx(score_output_path, sheets)
+    for path in export_paths:
+        export.write_rows(path, rows)
+
+
+def score_rows(student_rows, all_student_results, tests):
+    """Generate the rows of the score table from the rows of the student list.
+
+    The columns after the results are kept as they are in the student list.
+    """
+    student_rows = iter(student_rows)
     new_title = (
         ["name", "student_id"] + [t.test_name for t in tests] + ["in_log", "log_msg"]
     )
-    for idx, val in enumerate(new_title):
-        sheet.cell(row=1, column=idx + 1).value = val
-
-    # Save result to excel
-    for row in list(sheet.rows)[1:]:
-        # Skip title row so use [1:]
+    yield new_title + list(next(student_rows, [])[len(new_title) :])
 
+    for row in student_rows:
         # row[0] are students' name, row[1] are IDs
-        this_student_id = row[1].value
+        this_student_id = row[1]
 
-        this_student_result = [""] * len(tests)
         if not this_student_id in all_student_results.keys():
             this_student_result = append_log_msg(
-                this_student_result, "not submit", in_log=0
+                [""] * len(tests), "not submit", in_log=0
             )
         else:
             this_student_result = all_student_results[this_student_id]
-        for idx, test_result in enumerate(this_student_result):
-            sheet.cell(row=row[1].row, column=idx + 3).value = str(test_result)
+        yield (
+            list(row[:2])
+            + [str(test_result) for test_result in this_student_result]
+            + list(row[2 + len(this_student_result) :])
+        )
+
+
+def usage_rows(student_rows, all_student_usages, tests):
+    """Generate the rows of the `performance` worksheet of all students."""
+    title = ["name", "student_id"]
+    for t in tests:
+        title += [
+            t.test_name + " time(s)",
+            t.test_name + " cpu(s)",
+            t.test_name + " memory(MB)",
+        ]
+    yield title
+    for row in student_rows[1:]:
+        this_student_id = row[1]
+        values = [row[0], this_student_id]
+        usages = all_student_usages.get(this_student_id, [None] * len(tests))
+        for usage in usages:
+            if usage is None:
+                values += [None, None, None]
+                continue
+            values += [
+                usage.wall_time,
+                usage.cpu_time,
+                None if usage.max_rss is None else round(usage.max_rss / 1024, 1),
+            ]
+        yield values
+
+
+def update_sheet(score_output_path, all_student_results, export_paths=()):
+    """Update the results of the students in the score output.
 
-    book.save(score_output_path)
+    All students are updated by one load and save of the score output, where
+    only the columns of the tests are changed.
+    """
+    with trace.span("write_to_sheet"):
+        sheets = export.read_sheets(score_output_path)
+        _, rows = sheets[0]
+        title = rows[0]
+        for row in rows[1:]:
+            result = all_student_results.get(row[1])
+            if result is None:
+                continue
+            for idx, column in enumerate(title):
+                if column in ["name", "student_id", "in_log", "log_msg"]:
+                    continue
+                if idx - 2 >= len(result):
+                    break
+                row[idx] = str(result[idx - 2])
+        export.write_xlsx(score_output_path, sheets)
+        for path in export_paths:
+            export.write_rows(path, rows)
+
+
+def stored_student(result_pack, lj: LocalJudge):
+    """Make the student of the results store from the result of `judge_one_student`."""
+    return (
+        result_pack["student_id"],
+        result_pack["result"],
+        result_pack["usages"],
+        result_pack["diffs"],
+        lj.error_handler.get_error(result_pack["student_id"]),
+    )
+
+
+def print_stats(store: ResultStore, test_names):
+    """Print the changed verdicts of the last run and the most rejected tests."""
+    run_id = store.last_run()
+    if run_id is None:
+        print("No results in the store")
+        return
+    changes = store.changes(run_id)
+    print(f"{len(changes)} verdicts of run {run_id} changed from the previous runs")
+    for student_id, test_name, accepted in changes:
+        print(f"  {student_id} {test_name}: {'accepted' if accepted else 'rejected'}")
+    print(f"{'test':<16} {'rejected':>10} {'total':>10}")
+    for test_name, rejected, total in store.failures(test_names):
+        print(f"{test_name:<16} {rejected:>10} {total:>10}")
 
 
 def get_args():
@@ -277,22 +873,126 @@ def get_args():
     parser.add_argument(
         "-j",
         "--jobs",
-        help="number of jobs for multiprocessing",
+        help="number of jobs for multiprocessing "
+        + "(default: the number of CPUs, or 1 with `--test-jobs`)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--extract-jobs",
+        help="number of jobs to extract the archives ahead of judging (default: jobs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--engine",
+        help="process: judge the students on a pool of processes; "
+        + "asyncio: judge all students in this process, "
+        + "where `--jobs` is the number of running programs",
+        choices=["process", "asyncio"],
+        default="process",
+    )
+    parser.add_argument(
+        "--test-jobs",
+        help="number of tests of one student to run concurrently with `-j 1`, "
+        + "`-s`, or `-u` (default: 1)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-failures",
+        help="skip the remaining tests of a student after K tests are rejected",
         type=int,
-        default=multiprocessing.cpu_count(),
+        default=None,
+    )
+    parser.add_argument(
+        "--fail-fast",
+        help="skip the remaining tests of a student after the first rejected test, "
+        + "the same as `--max-failures 1`",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prioritize",
+        help="run the tests which fail most often and then the cheapest ones first, "
+        + "by the last results in the results store",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard",
+        help="only judge the K-th of N shards of the tests, e.g. 3/8",
+        type=index.parse_shard,
+        default=None,
     )
     parser.add_argument(
         "-u",
         "--update",
-        help="update specific student's score by rejudgement",
+        help="update the scores of the students (separated by commas) by rejudgement",
         type=str,
         default=None,
     )
-    return parser.parse_args()
-
-
-def setup():
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parser.add_argument(
+        "--export",
+        help="also export the score table to the file (.csv or .jsonl), "
+        + "which can be given more than once",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "-p",
+        "--performance",
+        help="write the time and memory of each test into the second worksheet",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep-diff",
+        help="render the diffs of the rejected tests to keep them in the results store",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats",
+        help="print the changed verdicts of the last run and the most rejected tests "
+        + "from the results store without judging",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        help="write the spans of extract, build, run, compare, and write_to_sheet "
+        + "into the file as JSON lines",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--chrome-trace",
+        help="write the spans into the file in the Chrome trace-event format",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        help="print the count, total, p50, p95, and max time of each stage",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only judge the new or changed archives since the last run",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    all_students = args.student is None and args.update is None
+    if args.test_jobs is None:
+        args.test_jobs = 1
+    elif all_students and args.jobs is None and args.engine == "process":
+        # The tests of each student run on threads instead of the pool
+        args.jobs = 1
+    elif all_students and (args.jobs > 1 or args.engine == "asyncio"):
+        # The tests of all students share the pool or the event loop instead
+        print(
+            "[WARNING] --test-jobs only applies to -j 1, -s, or -u, so it is ignored",
+            file=sys.stderr,
+        )
+        args.test_jobs = 1
+    if args.jobs is None:
+        args.jobs = multiprocessing.cpu_count()
+    return args
 
 
 def main():
@@ -301,6 +1001,10 @@ def main():
     if not os.path.isfile(args.ta_config):
         print("Config file `" + args.ta_config + "` not found.")
         return 1
+    for path in args.export:
+        if not export.is_supported(path):
+            print("Export file `" + path + "` is not .csv or .jsonl.")
+            return 1
 
     ta_config = configparser.ConfigParser()
     ta_config.read(args.ta_config)
@@ -317,11 +1021,34 @@ def main():
         "format": "%(asctime)-15s [%(levelname)s] %(message)s",
     }
 
+    trace_path = args.trace
+    if trace_path is None and (args.chrome_trace or args.profile):
+        trace_path = "ta_judge.trace.jsonl"
+    if trace_path is not None:
+        trace.enable(trace_path)
+
     eh = ErrorHandler(ta_config["Config"]["ExitOrLog"], **logging_config)
     tj = TaJudge(ta_config["TaConfig"], eh)
     lj = LocalJudge(ta_config["Config"], eh)
+    # The executable is always rebuilt, even if it is shipped in the archive
+    tj.workspace_private.append(lj.executable)
+    if not args.shard is None:
+        lj.shard(*args.shard)
+    score_output = ta_config["TaConfig"]["ScoreOutput"]
+    store = ResultStore(
+        ta_config["TaConfig"].get(
+            "ResultStore", os.path.splitext(score_output)[0] + ".db"
+        )
+    )
+    test_names = [t.test_name for t in lj.tests]
+    max_failures = 1 if args.fail_fast else args.max_failures
+    if args.prioritize:
+        lj.prioritize(store.test_stats(test_names, SKIPPED_VERDICT))
+
+    if args.stats:
+        print_stats(store, test_names)
 
-    if not args.student is None:
+    elif not args.student is None:
         # Assign specific student for this judgement and report to screen
         this_student_id = args.student
         tj.extract_afresh = "false"
@@ -334,115 +1061,178 @@ def main():
             "none",
             os.path.abspath(tj.students_extract_dir + os.sep + extract_path),
         )
-        res_dict = judge_one_student(student, None, tj, lj, False)
+        res_dict = judge_one_student(
+            student, None, tj, lj, False, args.test_jobs, None, max_failures
+        )
 
-        report = Report(report_verbose=args.verbose, score_dict=lj.score_dict)
+        report = Report(
+            report_verbose=args.verbose,
+            score_dict=json.loads(lj.score_dict),
+            total_score=json.loads(ta_config["Config"]["TotalScore"]),
+        )
         report.table = res_dict["report_table"]
         report.print_report()
 
     elif not args.update is None:
-        # Update one student's judge result
-        this_student_id = args.update
+        # Update the judge results of the students by one load and save
         tj.extract_afresh = "false"
-        extract_path = re.sub(
-            r"{student_id}", this_student_id, tj.update_student_pattern
+        all_student_results = {}
+        stored = []
+        for this_student_id in args.update.split(","):
+            extract_path = re.sub(
+                r"{student_id}", this_student_id, tj.update_student_pattern
+            )
+            student = Student(
+                this_student_id,
+                "none",
+                "none",
+                os.path.abspath(tj.students_extract_dir + os.sep + extract_path),
+            )
+            result_pack = judge_one_student(
+                student,
+                all_student_results,
+                tj,
+                lj,
+                False,
+                args.test_jobs,
+                args.keep_diff,
+                max_failures,
+            )
+            stored.append(stored_student(result_pack, lj))
+        store.add_students(store.start_run(test_names, "update"), test_names, stored)
+        update_sheet(
+            ta_config["TaConfig"]["ScoreOutput"], all_student_results, args.export
         )
-        student = Student(
-            this_student_id,
-            "none",
-            "none",
-            os.path.abspath(tj.students_extract_dir + os.sep + extract_path),
+
+    else:
+        manifest = Manifest(
+            ta_config["TaConfig"].get(
+                "ManifestFile", os.path.splitext(score_output)[0] + ".manifest.json"
+            ),
+            lj.judging_key(),
+            load=args.incremental,
         )
-        res_dict = judge_one_student(student, None, tj, lj, False)
-        result = res_dict["result"]
-        # Load existing table
-        book = load_workbook(ta_config["TaConfig"]["ScoreOutput"])
-        sheet = book.active
-        for row in sheet.rows:
-            if row[1].value == this_student_id:
-                for cell in row:
-                    if sheet.cell(row=1, column=cell.col_idx).value in [
-                        "name",
-                        "student_id",
-                        "in_log",
-                        "log_msg",
-                    ]:
-                        continue
-                    if cell.col_idx - 3 >= len(result):
-                        break
-                    cell.value = result[cell.col_idx - 3]
-                break
-        book.save(ta_config["TaConfig"]["ScoreOutput"])
-
-    elif args.jobs > 1:
-        # Test phase
-        with multiprocessing.Manager() as manager:
-            all_student_results = manager.dict()
-            pool = multiprocessing.Pool(args.jobs, setup)
-            async_result_list = [
-                {
-                    "student_id": s.id,
-                    "async_result": pool.apply_async(
-                        judge_one_student, (s, all_student_results, tj, lj, True)
-                    ),
-                }
-                for s in tj.students
-            ]
-            for async_result_i in async_result_list:
+        students = tj.students
+        if args.incremental:
+            students = manifest.changed(tj.students)
+            print(f"{len(students)} of {len(tj.students)} students are new or changed")
+        skipped = set()
+        if args.engine == "asyncio":
+            try:
+                (
+                    all_student_results,
+                    all_student_usages,
+                    all_student_diffs,
+                ) = judge_students_asyncio(
+                    students, tj, lj, args.jobs, args.keep_diff, max_failures
+                )
+            except KeyboardInterrupt:
+                return 1
+        elif args.jobs > 1:
+            # Test phase
+            try:
+                (
+                    all_student_results,
+                    all_student_usages,
+                    all_student_diffs,
+                ) = judge_students_parallel(
+                    students,
+                    tj,
+                    lj,
+                    args.jobs,
+                    args.extract_jobs,
+                    args.keep_diff,
+                    max_failures,
+                )
+            except KeyboardInterrupt:
+                return 1
+        else:
+            # Test in one thread
+            all_student_results = {}
+            all_student_usages = {}
+            all_student_diffs = {}
+            empty_result = [""] * len(lj.tests)
+            for student in students:
                 try:
-                    async_result_i["async_result"].get(
-                        float(lj.timeout) * len(lj.tests) * 10
+                    result_pack = judge_one_student(
+                        student,
+                        all_student_results,
+                        tj,
+                        lj,
+                        True,
+                        args.test_jobs,
+                        args.keep_diff,
+                        max_failures,
                     )
-                except multiprocessing.TimeoutError:
-                    print(async_result_i["student_id"], "total TLE skip")
-                    time.sleep(0.5)
-                    lj.error_handler.handle(
-                        "total TLE skip", student_id=async_result_i["student_id"]
+                    all_student_results[student.id] = result_pack["result"]
+                    all_student_usages[student.id] = result_pack["usages"]
+                    all_student_diffs[student.id] = result_pack["diffs"]
+                except KeyboardInterrupt:
+                    if input("\nReally quit? (y/n)> ").lower().startswith("y"):
+                        # Ref: https://stackoverflow.com/a/18115530
+                        print("Write current score to sheet")
+                        break
+                    print(f"Skip one student: {student.id}")
+                    lj.error_handler.handle("skip", student_id=student.id)
+                    result = append_log_msg(
+                        empty_result, lj.error_handler.get_error(student.id)
                     )
-
+                    all_student_results[student.id] = result
+                    skipped.add(student.id)
                     continue
-                except KeyboardInterrupt:
-                    pool.terminate()
-                    pool.join()
-                    return 1
-
-            pool.close()
-            pool.join()
-
-            write_to_sheet(
-                ta_config["TaConfig"]["ScoreOutput"],
-                ta_config["TaConfig"]["StudentList"],
-                dict(all_student_results),
-                lj.tests,
-            )
-    else:
-        # Test in one thread
-        all_student_results = {}
-        empty_result = [""] * len(lj.tests)
-        for student in tj.students:
-            try:
-                result_pack = judge_one_student(
-                    student, all_student_results, tj, lj, True
+        # Keep the results in the manifest for the next incremental run
+        for student in students:
+            if student.id in skipped:
+                manifest.forget(student.id)
+            elif student.id in all_student_results:
+                manifest.update(
+                    student,
+                    all_student_results[student.id],
+                    all_student_usages.get(student.id),
                 )
-                all_student_results[student.id] = result_pack["result"]
-            except KeyboardInterrupt:
-                if input("\nReally quit? (y/n)> ").lower().startswith("y"):
-                    # Ref: https://stackoverflow.com/a/18115530
-                    print("Write current score to sheet")
-                    break
-                print(f"Skip one student: {student.id}")
-                lj.error_handler.handle("skip", student_id=student.id)
-                result = append_log_msg(
-                    empty_result, lj.error_handler.get_error(student.id)
+        manifest.retain(tj.students)
+        manifest.save()
+        # Record the run, and make the score table from the results store
+        run_id = store.start_run(
+            test_names, "incremental" if args.incremental else "full"
+        )
+        store.add_students(
+            run_id,
+            test_names,
+            (
+                (
+                    student_id,
+                    result,
+                    all_student_usages.get(student_id),
+                    all_student_diffs.get(student_id),
+                    lj.error_handler.get_error(student_id),
                 )
-                all_student_results[student.id] = result
-                continue
+                for student_id, result in all_student_results.items()
+            ),
+        )
+        if args.incremental:
+            stored_results, stored_usages = store.latest_results(test_names)
+        else:
+            stored_results, stored_usages = store.run_results(run_id)
         write_to_sheet(
-            ta_config["TaConfig"]["ScoreOutput"],
+            score_output,
             ta_config["TaConfig"]["StudentList"],
-            all_student_results,
+            {**manifest.results(), **stored_results},
             lj.tests,
+            {**manifest.usages(), **stored_usages} if args.performance else None,
+            args.export,
         )
+    lj.close()
+    print_compiler_cache_stats(lj)
+    if trace_path is not None:
+        events = trace.load(trace_path)
+        if args.chrome_trace:
+            with open(args.chrome_trace, "w") as f:
+                json.dump(trace.to_chrome(events), f)
+        if args.profile:
+            print(trace.format_summary(trace.summarize(events)))
+        if args.trace is None:
+            os.remove(trace_path)
     print("Finished")
 
 
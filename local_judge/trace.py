@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import contextvars
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .report import format_seconds
+
+# The tracer of this process, or None when tracing is disabled
+_tracer = None
+# The tid of the asyncio task, or None for the tid of the thread
+_task_id = contextvars.ContextVar("trace_task_id", default=None)
+_task_ids = itertools.count(1)
+
+
+class Tracer:
+    """Append the spans as JSON lines to the trace file.
+
+    Each line is a complete event of the Chrome trace-event format, so the
+    file can be converted by `to_chrome`. Each worker of a pool enables a
+    tracer of the same file, and appends to it through its own descriptor.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def record(self, name, start, duration, tags):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start,
+            "dur": duration,
+            "pid": os.getpid(),
+            "tid": _task_id.get() or threading.get_ident(),
+            "args": tags,
+        }
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        # One write for each line, so the lines of the processes do not interleave
+        os.write(self._fd, (json.dumps(event) + "\n").encode("utf8"))
+
+
+def enable(path, truncate=True):
+    """Start recording the spans into the file, which is truncated first.
+
+    A pool worker appends to the file of its parent with `truncate` false.
+    """
+    global _tracer
+    if truncate:
+        open(path, "w").close()
+    _tracer = Tracer(path)
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+def get_path():
+    """Get the trace file, or None when tracing is disabled."""
+    return None if _tracer is None else _tracer.path
+
+
+def new_task():
+    """Record the spans of the current asyncio task under a tid of its own.
+
+    The tasks of the event loop share one thread, so their spans would
+    overlap on one track. The tid is kept in the context of the task, which
+    is copied to the threads it starts.
+    """
+    _task_id.set(next(_task_ids))
+
+
+@contextmanager
+def span(name, **tags):
+    """Record the wall time of the block as a span of the stage `name`."""
+    if _tracer is None:
+        yield
+        return
+    start = time.time_ns() // 1000
+    start_counter = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration = (time.perf_counter_ns() - start_counter) // 1000
+        _tracer.record(name, start, duration, tags)
+
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def to_chrome(events):
+    """Convert the spans to the JSON object format of Chrome trace events."""
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def percentile(sorted_values, p):
+    """Get the nearest-rank percentile of the sorted values."""
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(events):
+    """Get the count, total, p50, p95, and max seconds of each stage."""
+    durations = {}
+    for event in events:
+        durations.setdefault(event["name"], []).append(event["dur"] / 1e6)
+    summary = {}
+    for name, values in durations.items():
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "total": sum(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": values[-1],
+        }
+    return summary
+
+
+def format_summary(summary):
+    lines = [
+        "{:<16}{:>8}{:>12}{:>12}{:>12}{:>12}".format(
+            "stage", "count", "total", "p50", "p95", "max"
+        )
+    ]
+    for name, stats in sorted(summary.items(), key=lambda x: -x[1]["total"]):
+        lines.append(
+            "{:<16}{:>8}{:>12}{:>12}{:>12}{:>12}".format(
+                name,
+                stats["count"],
+                format_seconds(stats["total"]),
+                format_seconds(stats["p50"]),
+                format_seconds(stats["p95"]),
+                format_seconds(stats["max"]),
+            )
+        )
+    return "\n".join(lines)
@@ -22,6 +22,7 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import json
 import os, sys
 
 
@@ -42,6 +43,30 @@ def expand_path(dir, filename, extension):
     return os.path.abspath(os.path.join(dir, filename + extension))
 
 
+def parse_size(size):
+    """Parse a size with an optional unit into bytes
+
+    512 -> 512, 64K -> 65536, 1G -> 1073741824
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    size = str(size).strip().upper().rstrip("B")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def atomic_write_json(path, data, **kwargs):
+    """Dump `data` as JSON into `path` atomically
+
+    The file is written under a temporary name unique to this process and then
+    renamed, so concurrent writers and readers never see a partial file.
+    """
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+
 def create_specific_input(input_name_or_path, config):
     if os.path.isfile(input_name_or_path):
         specific_input = input_name_or_path
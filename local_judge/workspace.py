@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+MIT License
+
+Copyright (c) 2020 Huang Po-Hsuan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import errno
+import fcntl
+import os
+from fnmatch import fnmatch
+from shutil import copyfile, copystat, rmtree
+
+# extract: extract the archive into the workspace as it is
+# hardlink, reflink, copy: keep the extracted archive as a read-only pristine
+# tree, and make the workspace from it for each judgement
+MODES = ("extract", "hardlink", "reflink", "copy")
+
+# The ioctl to share the extents of a file on btrfs, XFS and so on
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Make a copy-on-write clone of the file."""
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def copy_file(src, dst, mode):
+    """Copy the file into the workspace by the mode.
+
+    Fall back to a plain copy if the file system does not support the mode.
+    The hard links share the read-only mode of the pristine files, and the
+    copies are writable.
+    """
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    if mode == "reflink":
+        try:
+            reflink(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL):
+                raise
+            copyfile(src, dst)
+    else:
+        copyfile(src, dst)
+    copystat(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | 0o200)
+
+
+def populate(pristine_path, workspace_path, mode, private=()):
+    """Make the workspace a fresh view of the pristine tree.
+
+    Everything left in the workspace by the last judgement is removed first.
+    The mtimes of the files are kept, so `make` sees the same tree in every judgement.
+    The files matching the glob patterns of `private`, relative to the tree,
+    are written by the build, so they are copied instead of linked.
+    """
+    rmtree(workspace_path, ignore_errors=True)
+    private = [os.path.normpath(pattern) for pattern in private]
+    for root, dirs, files in os.walk(pristine_path):
+        relpath = os.path.relpath(root, pristine_path)
+        target = os.path.join(workspace_path, relpath)
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            file_mode = mode
+            path = os.path.normpath(os.path.join(relpath, name))
+            if mode == "hardlink" and any(
+                fnmatch(path, pattern) for pattern in private
+            ):
+                file_mode = "copy"
+            copy_file(os.path.join(root, name), os.path.join(target, name), file_mode)
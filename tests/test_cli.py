@@ -22,10 +22,22 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+from contextlib import closing
 from pathlib import Path
 from typing import Tuple
+from zipfile import ZipFile
+import configparser
+import json
+import os
 import pytest
+import re
+import shutil
+import sqlite3
 import subprocess
+import sys
+import time
+from openpyxl import load_workbook
+from local_judge.error_handler import ErrorHandler
 
 
 def exec_command(cmd: str) -> Tuple[str, str, int]:
@@ -39,28 +51,203 @@ def exec_command(cmd: str) -> Tuple[str, str, int]:
     return process.stdout, process.stderr, process.returncode
 
 
+def write_config(src: Path, dst: Path, section: str = "Config", **fields) -> Path:
+    """Copy the config file with some fields overridden"""
+    config = configparser.RawConfigParser()
+    config.optionxform = str
+    config.read(src)
+    for key, value in fields.items():
+        config[section][key] = value
+    with open(dst, "w") as f:
+        config.write(f)
+    return dst
+
+
 @pytest.fixture
 def base_path() -> Path:
     """Get the current folder of the test"""
     return Path(__file__).parent.parent
 
 
-def test_judge_correct(base_path: Path, monkeypatch: pytest.MonkeyPatch):
-    monkeypatch.chdir(base_path / "examples" / "judge" / "correct")
+@pytest.fixture
+def examples_path(base_path: Path, tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Copy the examples, so the files written by the tests stay out of the tree"""
+    examples = tmp_path_factory.mktemp("repo") / "examples"
+    shutil.copytree(
+        base_path / "examples",
+        examples,
+        ignore=shutil.ignore_patterns("scanner", "extract", "hw1.*", "ta_judge.log"),
+    )
+    return examples
+
+
+def test_judge_correct(examples_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
     out, _, returncode = exec_command("judge")
     assert returncode == 0
     assert "100/100" in out
 
 
-def test_judge_wrong(base_path: Path, monkeypatch: pytest.MonkeyPatch):
-    monkeypatch.chdir(base_path / "examples" / "judge" / "wrong")
+def test_judge_special_output_path(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
+    # Not a backreference nor a word split of the substituted command
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        TempOutputDir=str(tmp_path / r"out \g<0>"),
+    )
+    out, _, returncode = exec_command(f"judge -c {config}")
+    assert returncode == 0
+    assert "100/100" in out
+
+
+def test_judge_test_index_shard(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
+    shutil.copytree("../input", tmp_path / "input")
+    shutil.copytree("../answer", tmp_path / "answer")
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        Inputs=str(tmp_path / "input" / "*.txt"),
+        AnswerDir=str(tmp_path / "answer"),
+        TestIndexFile=str(tmp_path / "index.json"),
+    )
+    out, _, returncode = exec_command(f"judge -c {config} --shard 2/2")
+    assert returncode == 0
+    assert "Correct/Total problems:\t2/2" in out
+    out, _, returncode = exec_command(f"judge -c {config} -i gg")
+    assert returncode == 0
+    assert "Correct/Total problems:\t1/1" in out
+    with open(tmp_path / "index.json") as f:
+        assert [t[0] for t in json.load(f)["tests"]] == ["a", "b", "gg", "xxxx"]
+    # The cached index is invalidated by the removed answer
+    os.remove(tmp_path / "answer" / "gg.out")
+    out, _, returncode = exec_command(f"judge -c {config}")
+    assert returncode != 0
+    assert "no any corresponding answer" in out
+    with open(tmp_path / "index.json") as f:
+        assert json.load(f)["missing"] == [str(tmp_path / "answer" / "gg.out")]
+
+
+@pytest.mark.parametrize("delete_temp_output", ["true", "false"])
+def test_judge_scratch_dir(
+    examples_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+    delete_temp_output: str,
+):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        ScratchDir=str(tmp_path / "scratch"),
+        DeleteTempOutput=delete_temp_output,
+    )
+    out, _, returncode = exec_command(f"judge -c {config}")
+    assert returncode == 0
+    assert "100/100" in out
+    outputs = sorted(os.listdir(tmp_path / "scratch"))
+    if delete_temp_output == "true":
+        assert outputs == []
+    else:
+        # The directory of each run is its own
+        assert len(outputs) == 1 and outputs[0].startswith("local-")
+        assert sorted(os.listdir(tmp_path / "scratch" / outputs[0])) == [
+            "a.out",
+            "b.out",
+            "gg.out",
+            "xxxx.out",
+        ]
+
+
+def test_judge_compiler_cache(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        CompilerCacheDir=str(tmp_path / "compiler_cache"),
+    )
+    for stats in ("0 hits, 1 misses", "1 hits, 0 misses"):
+        out, _, returncode = exec_command(f"judge -c {config}")
+        assert returncode == 0
+        assert "100/100" in out
+        assert f"Compiler cache: {stats}" in out
+
+
+def test_judge_prioritize_fail_fast(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "judge" / "wrong")
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        TestHistoryFile=str(tmp_path / "history.json"),
+    )
+    # The history is not kept without the options which use it
+    exec_command(f"judge -c {config}")
+    assert not (tmp_path / "history.json").exists()
+    # xxxx is the only rejected test, which is the last one by name
+    out, _, _ = exec_command(f"judge -c {config} --fail-fast")
+    assert "3/4" in out
+    with open(tmp_path / "history.json") as f:
+        assert json.load(f)["xxxx"]["failures"] == 1
+    # It fails most often, so it runs first and the others are skipped
+    out, _, _ = exec_command(f"judge -c {config} --fail-fast --prioritize -v 1")
+    assert "0/4" in out
+    assert out.count("skipped after too many failures") == 3
+
+
+def test_judge_calibrate(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
+    fields = {"TimeoutFile": str(tmp_path / "timeouts.json"), "BuildTimeout": "30"}
+    config = write_config(Path("judge.conf"), tmp_path / "judge.conf", **fields)
+    out, _, returncode = exec_command(f"judge -c {config} --calibrate 3")
+    assert returncode == 0
+    with open(tmp_path / "timeouts.json") as f:
+        data = json.load(f)
+    assert data["runs"] == 3
+    assert sorted(data["baselines"]) == ["a", "b", "gg", "xxxx"]
+    out, _, returncode = exec_command(f"judge -c {config}")
+    assert "100/100" in out
+    # Only the given test is calibrated again
+    out, _, returncode = exec_command(f"judge -c {config} --calibrate 1 -i a")
+    assert returncode == 0
+    with open(tmp_path / "timeouts.json") as f:
+        assert sorted(json.load(f)["baselines"]) == ["a", "b", "gg", "xxxx"]
+    # No test can finish within the derived timeouts
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        TimeoutFactor="0",
+        TimeoutFloor="0",
+        **fields,
+    )
+    out, _, returncode = exec_command(f"judge -c {config}")
+    assert returncode != 0
+    assert "TLE at a" in out
+    # The calibration itself is not limited by the derived timeouts
+    out, _, returncode = exec_command(f"judge -c {config} --calibrate 1")
+    assert returncode == 0
+    assert "Failed to calibrate" not in out
+
+
+def test_judge_wrong(examples_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(examples_path / "judge" / "wrong")
     out, _, returncode = exec_command("judge")
     assert returncode != 0
     assert "90/100" in out
 
 
-def test_ta_judge(base_path: Path, monkeypatch: pytest.MonkeyPatch):
-    monkeypatch.chdir(base_path / "examples" / "ta_judge")
+def test_ta_judge(examples_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(examples_path / "ta_judge")
     out, _, returncode = exec_command("ta_judge")
     assert returncode == 0
     assert "OU2345678" in out
@@ -69,3 +256,458 @@ def test_ta_judge(base_path: Path, monkeypatch: pytest.MonkeyPatch):
     with open("ta_judge.log") as f:
         log = f.read()
         assert "[ERROR] F87654321 Failed in build stage" in log
+
+
+def test_ta_judge_jobs(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    _, _, returncode = exec_command("ta_judge -j 2")
+    assert returncode == 0
+    sheet = load_workbook("hw1.xlsx").active
+    rows = {row[1]: row for row in sheet.iter_rows(values_only=True)}
+    assert rows["F12345678"][2:7] == ("1",) * 5
+    assert rows["F87654321"][2:7] == ("0",) * 5
+    assert rows["F87654321"][8].startswith("Failed in build stage")
+    # Every scratch directory is removed, even with a shard of the tests
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        ScratchDir=str(tmp_path / "scratch"),
+    )
+    _, _, returncode = exec_command(f"ta_judge -t {config} -j 2 --shard 1/2")
+    assert returncode == 0
+    assert os.listdir(tmp_path / "scratch") == []
+    # The tests of all students share the pool instead
+    _, err, returncode = exec_command(f"ta_judge -t {config} -j 2 --test-jobs 2")
+    assert returncode == 0
+    assert "--test-jobs only applies" in err
+    # Without -j, the students are judged one by one with their tests on threads
+    _, err, returncode = exec_command(f"ta_judge -t {config} --test-jobs 2")
+    assert returncode == 0
+    assert "--test-jobs" not in err
+    sheet = load_workbook("hw1.xlsx").active
+    rows = {row[1]: row for row in sheet.iter_rows(values_only=True)}
+    assert rows["F12345678"][2:7] == ("1",) * 5
+
+
+def test_ta_judge_jobs_task_deadline(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    from local_judge import ta_judge
+
+    monkeypatch.chdir(examples_path / "ta_judge")
+    config = configparser.ConfigParser()
+    config.read(write_config(Path("ta_judge.conf"), tmp_path / "t.conf", Timeout="1"))
+    error_handler = ErrorHandler("log", filename=str(tmp_path / "ta_judge.log"))
+    tj = ta_judge.TaJudge(config["TaConfig"], error_handler)
+    lj = ta_judge.LocalJudge(config["Config"], error_handler)
+    # The extraction hangs in every worker forked from here
+    monkeypatch.setattr(ta_judge, "TASK_GRACE", 0)
+    monkeypatch.setattr(ta_judge.TaJudge, "extract_student", lambda *_: time.sleep(60))
+    results, _, _ = ta_judge.judge_students_parallel(tj.students, tj, lj, 2)
+    for student in tj.students:
+        assert results[student.id][-1].startswith("TLE at extract stage")
+
+
+def test_ta_judge_asyncio_engine(examples_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    out, _, returncode = exec_command("ta_judge --engine asyncio -j 4")
+    assert returncode == 0
+    assert "Finished" in out
+    sheet = load_workbook("hw1.xlsx").active
+    rows = {row[1]: row for row in sheet.iter_rows(values_only=True)}
+    assert rows["F12345678"][2:7] == ("1",) * 5
+    assert rows["F87654321"][8].startswith("Failed in build stage")
+
+
+def test_ta_judge_trace(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    trace_path = tmp_path / "trace.jsonl"
+    chrome_trace_path = tmp_path / "trace.json"
+    out, _, returncode = exec_command(
+        f"ta_judge -j 2 --trace {trace_path} --chrome-trace {chrome_trace_path} "
+        + "--profile"
+    )
+    assert returncode == 0
+    for stage in ("extract", "build", "run", "compare", "write_to_sheet"):
+        assert stage in out
+    with open(trace_path) as f:
+        names = {json.loads(line)["name"] for line in f}
+    assert names == {"extract", "build", "run", "compare", "write_to_sheet"}
+    with open(chrome_trace_path) as f:
+        assert len(json.load(f)["traceEvents"]) > 0
+    # The spans of the students judged on one event loop are on their own tracks
+    exec_command(f"ta_judge --engine asyncio -j 4 --trace {trace_path}")
+    with open(trace_path) as f:
+        events = [json.loads(line) for line in f]
+    builds = [e for e in events if e["name"] == "build"]
+    assert len({e["tid"] for e in builds}) == len(builds)
+
+
+def test_ta_judge_update_export(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    _, _, returncode = exec_command("ta_judge -j 2 -p")
+    assert returncode == 0
+    out, _, returncode = exec_command(
+        f"ta_judge -u F12345678,F87654321 --export {tmp_path / 'hw1.csv'} "
+        + f"--export {tmp_path / 'hw1.jsonl'}"
+    )
+    assert returncode == 0
+    assert "F12345678" in out and "F87654321" in out
+    book = load_workbook("hw1.xlsx")
+    assert book.sheetnames == ["Sheet", "performance"]
+    rows = {row[1]: row for row in book.active.iter_rows(values_only=True)}
+    assert rows["F12345678"][2:7] == ("1",) * 5
+    with open(tmp_path / "hw1.csv") as f:
+        assert f.readline().startswith("name,student_id,a,b,gg,hide,xxxx")
+    with open(tmp_path / "hw1.jsonl") as f:
+        rows = {row["student_id"]: row for row in map(json.loads, f)}
+    assert rows["OU2345679"]["log_msg"] == "not submit"
+
+
+def test_ta_judge_result_store(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        "TaConfig",
+        ResultStore=str(tmp_path / "hw1.db"),
+    )
+    for cmd in (f"ta_judge -t {config} -j 2", f"ta_judge -t {config} -u F12345678"):
+        _, _, returncode = exec_command(cmd)
+        assert returncode == 0
+    with closing(sqlite3.connect(tmp_path / "hw1.db")) as conn:
+        assert conn.execute("SELECT mode FROM runs").fetchall() == [
+            ("full",),
+            ("update",),
+        ]
+        assert (
+            conn.execute(
+                "SELECT accepted FROM verdicts WHERE run_id = 2 ORDER BY test_index"
+            ).fetchall()
+            == [(1,)] * 5
+        )
+    out, _, returncode = exec_command(f"ta_judge -t {config} --stats")
+    assert returncode == 0
+    assert "0 verdicts of run 2 changed from the previous runs" in out
+    assert re.search(r"a\s+2\s+3", out)
+
+
+@pytest.mark.parametrize("workspace_mode", ["hardlink", "reflink", "copy"])
+def test_ta_judge_workspace_mode(
+    examples_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+    workspace_mode: str,
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        "TaConfig",
+        StudentsExtractDir=str(tmp_path / "extract"),
+        WorkspaceMode=workspace_mode,
+    )
+    _, _, returncode = exec_command(f"ta_judge -t {config} -j 2")
+    assert returncode == 0
+    pristine = tmp_path / "extract" / ".pristine" / "F12345678_HW1"
+    assert (pristine / "main.c").stat().st_mode & 0o222 == 0
+    # The build output is only in the workspace
+    (tmp_path / "extract" / "F12345678_HW1" / "main.o").touch()
+    _, _, returncode = exec_command(f"ta_judge -t {config} -u F12345678")
+    assert returncode == 0
+    assert not (tmp_path / "extract" / "F12345678_HW1" / "main.o").exists()
+    rows = {
+        row[1]: row
+        for row in load_workbook("hw1.xlsx").active.iter_rows(values_only=True)
+    }
+    assert rows["F12345678"][2:7] == ("1",) * 5
+    # The shipped executable is never shared, since the build writes it
+    write_config(config, config, BuildCommand="make")
+    _, _, returncode = exec_command(f"ta_judge -t {config} -u F12345678")
+    assert returncode == 0
+    assert not os.path.samefile(
+        pristine / "scanner", tmp_path / "extract" / "F12345678_HW1" / "scanner"
+    )
+
+
+def test_ta_judge_extract_limit(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        "TaConfig",
+        StudentsExtractDir=str(tmp_path / "extract"),
+        ExtractMaxFiles="2",
+    )
+    _, _, returncode = exec_command(f"ta_judge -t {config} -j 2")
+    assert returncode == 0
+    with open("ta_judge.log") as f:
+        assert "`F12345678` failed in extract stage. more than 2 files" in f.read()
+
+
+def test_ta_judge_incremental(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    shutil.copytree("zip", tmp_path / "zip")
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        "TaConfig",
+        StudentsZipContainer=str(tmp_path / "zip"),
+        StudentsExtractDir=str(tmp_path / "extract"),
+        ScoreOutput=str(tmp_path / "hw1.xlsx"),
+    )
+    out, _, returncode = exec_command(f"ta_judge -t {config}")
+    assert returncode == 0
+    assert (tmp_path / "hw1.manifest.json").is_file()
+
+    # Only touched
+    os.utime(tmp_path / "zip" / "F12345678_HW1.zip")
+    out, _, returncode = exec_command(f"ta_judge -t {config} --incremental")
+    assert "0 of 3 students are new or changed" in out
+    # Resubmitted
+    with ZipFile(tmp_path / "zip" / "F87654321_HW1.zip", "a") as z:
+        z.writestr("F87654321_HW1/README", "resubmitted")
+    out, _, returncode = exec_command(f"ta_judge -t {config} --incremental")
+    assert "1 of 3 students are new or changed" in out
+    assert "F87654321" in out and "F12345678" not in out
+    sheet = load_workbook(tmp_path / "hw1.xlsx").active
+    rows = {row[1]: row for row in sheet.iter_rows(values_only=True)}
+    assert rows["F12345678"][2:7] == ("1",) * 5
+    # The results are judged again under another config or another answer
+    write_config(config, config, Timeout="5")
+    out, _, returncode = exec_command(f"ta_judge -t {config} --incremental")
+    assert "3 of 3 students are new or changed" in out
+    out, _, returncode = exec_command(f"ta_judge -t {config} --incremental")
+    assert "0 of 3 students are new or changed" in out
+    with open(next(Path("judge_resources/answer").iterdir()), "a") as f:
+        f.write("changed\n")
+    out, _, returncode = exec_command(f"ta_judge -t {config} --incremental")
+    assert "3 of 3 students are new or changed" in out
+
+
+def test_judge_test_jobs(examples_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(examples_path / "judge" / "wrong")
+    out, _, returncode = exec_command("judge --test-jobs 4")
+    assert returncode != 0
+    assert "90/100" in out
+
+
+def test_judge_launcher_without_memory(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "judge" / "correct")
+    # The programs are started directly, by the launchers shared by the threads
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        RunMode="launcher",
+        MeasureMemory="false",
+    )
+    out, _, returncode = exec_command(f"judge -c {config} --test-jobs 4")
+    assert returncode == 0
+    assert "100/100" in out
+
+
+@pytest.mark.parametrize("run_mode", ["file", "pipe", "launcher"])
+@pytest.mark.parametrize("comparator", ["builtin:exact", "builtin:ignore-trailing-ws"])
+def test_judge_builtin_comparator(
+    examples_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+    comparator: str,
+    run_mode: str,
+):
+    monkeypatch.chdir(examples_path / "judge" / "wrong")
+    config = write_config(
+        Path("judge.conf"),
+        tmp_path / "judge.conf",
+        DiffCommand=comparator,
+        RunMode=run_mode,
+    )
+    out, _, _ = exec_command(f"judge -c {config} -v 1")
+    assert "90/100" in out
+    assert "4294967295" in out  # the rejected test is rendered by DiffRenderCommand
+
+
+def test_ta_judge_build_cache(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    cache_dir = tmp_path / "build_cache"
+    builds = tmp_path / "builds.log"
+    # The build leaves an intermediate file in the tree as lex does
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        BuildCacheDir=str(cache_dir),
+        BuildCommand=f"make clean && make && touch lex.yy.c && echo >> {builds}",
+    )
+    for _ in range(2):
+        out, _, returncode = exec_command(f"ta_judge -t {config}")
+        assert returncode == 0
+        assert "Finished" in out
+        # The second run restores the executable without building it again
+        assert len(builds.read_text().splitlines()) == 1
+    # The submission failed to build is not cached
+    assert len(list(cache_dir.glob("?" * 64))) == 1
+
+
+def test_ta_judge_result_cache(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    cache_file = tmp_path / "results.db"
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        ResultCacheFile=str(cache_file),
+    )
+    _, _, returncode = exec_command(f"ta_judge -t {config}")
+    assert returncode == 0
+    assert cache_file.is_file()
+    out, _, returncode = exec_command(f"ta_judge -t {config} -s F12345678")
+    assert returncode == 0
+    assert "4/4" in out
+    # The verdicts under other resource limits are not reused
+    with closing(sqlite3.connect(cache_file)) as conn:
+        count = conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+    config = write_config(
+        Path("ta_judge.conf"),
+        tmp_path / "ta_judge.conf",
+        ResultCacheFile=str(cache_file),
+        OutputLimit="1M",
+    )
+    _, _, returncode = exec_command(f"ta_judge -t {config}")
+    assert returncode == 0
+    with closing(sqlite3.connect(cache_file)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0] == 2 * count
+
+
+def write_program(examples_path: Path, tmp_path: Path, source: str, **fields) -> Path:
+    """Write a C program with its config judged by the inputs of `examples/judge`"""
+    (tmp_path / "main.c").write_text(source)
+    (tmp_path / "Makefile").write_text("all:\n\tgcc -o scanner main.c\n")
+    return write_config(
+        examples_path / "judge" / "wrong" / "judge.conf",
+        tmp_path / "judge.conf",
+        BuildCommand="make",
+        Inputs=str(examples_path / "judge" / "input" / "*.txt"),
+        AnswerDir=str(examples_path / "judge" / "answer"),
+        ExitOrLog="log",
+        **fields,
+    )
+
+
+@pytest.mark.parametrize("run_mode", ["file", "launcher"])
+def test_judge_output_limit(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path, run_mode: str
+):
+    config = write_program(
+        examples_path,
+        tmp_path,
+        '#include <stdio.h>\nint main() { for (;;) puts("runaway"); }\n',
+        OutputLimit="1M",
+        RunMode=run_mode,
+    )
+    monkeypatch.chdir(tmp_path)
+    out, _, _ = exec_command(f"judge -c {config} -v 1")
+    assert "OLE: output limit exceeded" in out
+    assert "0/100" in out
+
+
+def test_judge_result_cache_errors(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    config = write_program(
+        examples_path,
+        tmp_path,
+        "#include <stdio.h>\n" 'int main() { fputs("crashed", stderr); return 1; }\n',
+        ResultCacheFile=str(tmp_path / "results.db"),
+    )
+    monkeypatch.chdir(tmp_path)
+    # The error of the cached verdict is logged again
+    for _ in range(2):
+        out, err, _ = exec_command(f"judge -c {config}")
+        assert "0/100" in out
+        assert err.count("Failed in run stage") == 4
+        assert "crashed" in err
+
+
+@pytest.mark.parametrize("run_mode", ["file", "launcher"])
+def test_judge_memory_limit(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path, run_mode: str
+):
+    config = write_program(
+        examples_path,
+        tmp_path,
+        "#include <stdio.h>\n#include <stdlib.h>\n#include <string.h>\n"
+        "int main() {\n"
+        "    for (int i = 0; i < 256; i++) {\n"
+        "        char *p = malloc(1 << 20);\n"
+        "        if (!p) return 1;\n"
+        "        memset(p, 1, 1 << 20);\n"
+        "    }\n"
+        "}\n",
+        MemoryLimit="64M",
+        RunMode=run_mode,
+    )
+    monkeypatch.chdir(tmp_path)
+    out, _, _ = exec_command(f"judge -c {config} -v 1")
+    assert "MLE: memory limit exceeded" in out
+    assert "0/100" in out
+    # A failed run within the limit is not an MLE, whatever its message is
+    config = write_program(
+        examples_path,
+        tmp_path,
+        "#include <stdio.h>\n"
+        'int main() { fputs("out of memory", stderr); return 1; }\n',
+        MemoryLimit="18M",
+        RunMode=run_mode,
+    )
+    out, _, _ = exec_command(f"judge -c {config} -v 1")
+    assert "0/100" in out
+    assert "MLE" not in out
+
+
+def test_ta_judge_performance(
+    examples_path: Path, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.chdir(examples_path / "ta_judge")
+    config = write_config(Path("ta_judge.conf"), tmp_path / "ta_judge.conf", Repeat="3")
+    _, _, returncode = exec_command(f"ta_judge -t {config} -p")
+    assert returncode == 0
+    sheet = load_workbook("hw1.xlsx")["performance"]
+    rows = {row[1]: row for row in sheet.iter_rows(values_only=True)}
+    assert rows["student_id"][2:5] == ("a time(s)", "a cpu(s)", "a memory(MB)")
+    assert all(value is not None for value in rows["F12345678"][2:])
+
+
+def test_bench_pipeline(base_path: Path, tmp_path: Path):
+    result = tmp_path / "result.json"
+    _, _, returncode = exec_command(
+        f"{sys.executable} {base_path / 'benchmarks' / 'bench_pipeline.py'} "
+        f"--students 2 --tests 2 --kinds correct,crash --large-kb 0 -o {result}"
+    )
+    assert returncode == 0
+    data = json.loads(result.read_text())
+    assert data["accepted"] == 2
+    assert set(data["stages"]) == {
+        "extract",
+        "build",
+        "run",
+        "compare",
+        "report",
+        "xlsx_write",
+    }